@@ -0,0 +1,361 @@
+"""Benchmarks for the expense calculator.
+
+Usage: python bench_exp_calc.py <ids|validation> [--sizes 10000,100000,1000000]
+       python bench_exp_calc.py generate [--data-dir bench_data] [--sizes 1000,100000,1000000,10000000]
+       python bench_exp_calc.py run [--data-dir bench_data] [--sizes ...] [--output results.json]
+                                    [--baseline baseline.json] [--tolerance 0.2]
+
+<generate> writes budget_<rows>.json databases and expenses_<rows>.csv files with
+the same pseudo-random content on every run, <run> generates missing ones itself.
+<run> times library functions and whole CLI commands on them, saves the results as
+json and, with --baseline, compares them with an earlier result file, exiting
+with 1 when anything got slower by more than the tolerance.
+
+<ids> compares id assignment during CSV import: the old find_next_id call per row
+against a shared IdAllocator. find_next_id is quadratic, so for big sizes its
+cost is estimated from a sample of calls instead of being measured in full.
+<validation> compares the former per row CSV_import validation (character by
+character amount check) followed by float() against validate_rows on whole columns.
+"""
+
+import contextlib
+import csv
+from dataclasses import dataclass
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import time
+from typing import Callable, Iterator
+
+import click
+from click.testing import CliRunner
+
+from expense_calculator import (
+    IMPORT_BATCH_SIZE,
+    Expense,
+    ExpenseStats,
+    IdAllocator,
+    batched,
+    clack,
+    db_meta_path,
+    find_next_id,
+    print_expenses,
+    read_db_meta,
+    read_db_or_init,
+    read_expenses,
+    save_db,
+    validate_rows,
+    write_db_file,
+    write_db_meta,
+)
+
+QUADRATIC_SAMPLE = 200
+SUITE_SIZES = "1000,100000,1000000,10000000"
+SEED = 1991
+DESCRIPTIONS = ("Chleb", "Mleko", "Czynsz", "Paliwo", "Kino", "Prąd", "Internet", "Obiad", "Bilet", "Leki")
+# Sizes up to this one are timed several times, the best time is kept
+REPEAT_UP_TO = 100000
+REPEATS = 3
+# Differences between timings shorter than this are noise
+NOISE_FLOOR = 0.005
+
+
+def make_expenses(rows: int) -> list[Expense]:
+    return [Expense(id=i, amount=1.0, description="Bench") for i in range(1, rows + 1)]
+
+
+def time_find_next_id(rows: int) -> tuple[float, bool]:
+    """Returns time of assigning ids to `rows` new items and whether it was estimated."""
+    expense_list = []
+    sample = min(rows, QUADRATIC_SAMPLE)
+    if sample < rows:
+        expense_list = make_expenses(rows - sample)
+    start = time.perf_counter()
+    for _ in range(sample):
+        expense_list.append(Expense(id=find_next_id(expense_list), amount=1.0, description="Bench"))
+    elapsed = time.perf_counter() - start
+    if sample == rows:
+        return elapsed, False
+    # Call cost grows linearly with list size, so the sum over all rows is
+    # roughly rows * (average call cost), i.e. half of the cost at the end.
+    return elapsed / sample * rows / 2, True
+
+
+def time_allocator(rows: int) -> float:
+    expense_list = []
+    allocator = IdAllocator(expense_list)
+    start = time.perf_counter()
+    for _ in range(rows):
+        expense_list.append(Expense(id=allocator.next_id(), amount=1.0, description="Bench"))
+    return time.perf_counter() - start
+
+
+@dataclass
+class LegacyCsvImport:
+    """CSV_import as it was before validate_rows"""
+    amount: str
+    description: str
+
+    def __post_init__(self):
+        legacy_validate_amount(self.amount)
+        if not self.description:
+            raise ValueError("Opis nie może być pusty")
+
+
+def legacy_validate_amount(amount: str) -> None:
+    if amount[0] == "-":
+        raise ValueError("Koszt nie może być ujemny")
+    if "." not in amount:
+        if not amount.isnumeric():
+            raise ValueError("Wszystkie koszty muszą być liczbami")
+    else:
+        counter = 0
+        for each in amount:
+            if each == ".":
+                counter += 1
+                if counter > 1:
+                    raise ValueError("Wszystkie koszty muszą być liczbami")
+            elif not each.isnumeric():
+                raise ValueError("Wszystkie koszty muszą być liczbami")
+
+
+def generate_rows(rows: int, seed: int = SEED) -> Iterator[tuple[float, str]]:
+    """Same (amount, description) pairs for the same arguments. Amounts have
+    at most two decimals, about one in a thousand is a huge one (>= 10 000 000)."""
+    rng = random.Random(seed)
+    for _ in range(rows):
+        if rng.random() < 0.001:
+            amount = rng.randrange(10 ** 9, 10 ** 11) / 100
+        else:
+            amount = rng.randrange(1, 500000) / 100
+        yield amount, f"{rng.choice(DESCRIPTIONS)} {rng.randrange(1000)}"
+
+
+def generate_db(filename: str, rows: int) -> None:
+    """Writes the database batch by batch, as import-csv would, with its meta file"""
+    stats = ExpenseStats()
+
+    def expenses() -> Iterator[Expense]:
+        for id, (amount, description) in enumerate(generate_rows(rows), 1):
+            item = Expense.trusted(id, amount, description)
+            stats.add(item)
+            yield item
+
+    write_db_file(filename, batched(expenses(), IMPORT_BATCH_SIZE))
+    write_db_meta(filename, stats)
+
+
+def generate_csv(filename: str, rows: int) -> None:
+    with open(filename, "w", encoding="utf-8", newline="") as stream:
+        writer = csv.writer(stream)
+        writer.writerow(["amount", "description"])
+        writer.writerows((f"{amount:.2f}", description) for amount, description in generate_rows(rows))
+
+
+def data_files(data_dir: str, rows: int) -> tuple[str, str]:
+    """Paths of the database and csv file with `rows` rows, generated if missing"""
+    os.makedirs(data_dir, exist_ok=True)
+    db_file = os.path.join(data_dir, f"budget_{rows}.json")
+    csv_file = os.path.join(data_dir, f"expenses_{rows}.csv")
+    # Data generated by an older format version is generated again
+    if read_db_meta(db_file) is None:
+        generate_db(db_file, rows)
+    if not os.path.exists(csv_file):
+        generate_csv(csv_file, rows)
+    return db_file, csv_file
+
+
+def copy_db(db_file: str, target: str) -> None:
+    shutil.copyfile(db_file, target)
+    # Meta file has to describe the copy, not the original
+    write_db_meta(target, read_stats(db_file))
+
+
+def read_stats(db_file: str) -> ExpenseStats:
+    with open(db_meta_path(db_file), encoding="utf-8") as stream:
+        return ExpenseStats(**json.load(stream)["stats"])
+
+
+def run_cli(*args: str) -> None:
+    result = CliRunner().invoke(clack, list(args))
+    if result.exit_code != 0:
+        raise RuntimeError(f"{' '.join(args)} failed: {result.output[-500:]}")
+
+
+# Every benchmark gets the database, csv file and a scratch directory. It does
+# its setup and returns the function to be timed.
+def bench_read_db_or_init(db_file: str, csv_file: str, scratch: str) -> Callable[[], object]:
+    return lambda: read_db_or_init(db_file)
+
+
+def bench_save_db(db_file: str, csv_file: str, scratch: str) -> Callable[[], object]:
+    expense_list = read_db_or_init(db_file)
+    target = os.path.join(scratch, "saved.json")
+    return lambda: save_db(expense_list, target)
+
+
+def bench_find_next_id(db_file: str, csv_file: str, scratch: str) -> Callable[[], object]:
+    expense_list = read_db_or_init(db_file)
+    return lambda: find_next_id(expense_list)
+
+
+def bench_read_expenses(db_file: str, csv_file: str, scratch: str) -> Callable[[], object]:
+    return lambda: read_expenses(csv_file, [])
+
+
+def bench_print_expenses(db_file: str, csv_file: str, scratch: str) -> Callable[[], object]:
+    expense_list = read_db_or_init(db_file)
+
+    def render() -> None:
+        with open(os.devnull, "w", encoding="utf-8") as devnull, contextlib.redirect_stdout(devnull):
+            print_expenses(expense_list)
+    return render
+
+
+def bench_cli_report(db_file: str, csv_file: str, scratch: str) -> Callable[[], object]:
+    return lambda: run_cli("report", f"--filename={db_file}")
+
+
+def bench_cli_export_python(db_file: str, csv_file: str, scratch: str) -> Callable[[], object]:
+    return lambda: run_cli("export-python", f"--filename={db_file}")
+
+
+def bench_cli_add(db_file: str, csv_file: str, scratch: str) -> Callable[[], object]:
+    target = os.path.join(scratch, "add.json")
+    copy_db(db_file, target)
+    return lambda: run_cli("add", "12.5", "Kawa", f"--filename={target}")
+
+
+def bench_cli_import_csv(db_file: str, csv_file: str, scratch: str) -> Callable[[], object]:
+    target = os.path.join(scratch, "import.json")
+    copy_db(db_file, target)
+    return lambda: run_cli("import-csv", csv_file, f"--filename={target}", "--jobs=1")
+
+
+BENCHMARKS = {
+    "read_db_or_init": bench_read_db_or_init,
+    "save_db": bench_save_db,
+    "find_next_id": bench_find_next_id,
+    "read_expenses": bench_read_expenses,
+    "print_expenses": bench_print_expenses,
+    "cli report": bench_cli_report,
+    "cli export-python": bench_cli_export_python,
+    "cli add": bench_cli_add,
+    "cli import-csv": bench_cli_import_csv,
+}
+
+
+def time_benchmark(benchmark: Callable, db_file: str, csv_file: str, scratch: str, repeats: int) -> float:
+    """Best of `repeats` runs, setup is repeated before each so commands
+    changing the database always start from the generated one"""
+    best = float("inf")
+    for _ in range(repeats):
+        function = benchmark(db_file, csv_file, scratch)
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def compare_results(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Prints current timings next to the baseline ones, returns names of
+    benchmarks (with row count) slower by more than tolerance"""
+    slower = []
+    print(f"{'benchmark':<20}  {'rows':>10}  {'baseline':>10}  {'current':>10}  {'change':>8}")
+    for name, timings in results["results"].items():
+        for rows, current in timings.items():
+            previous = baseline.get("results", {}).get(name, {}).get(rows)
+            if previous is None:
+                continue
+            change = current / previous - 1 if previous else 0.0
+            flag = ""
+            if change > tolerance and current - previous > NOISE_FLOOR:
+                flag = "  SLOWER"
+                slower.append(f"{name} ({rows})")
+            print(f"{name:<20}  {rows:>10}  {previous:>9.3f}s  {current:>9.3f}s  {change:>+7.0%}{flag}")
+    return slower
+
+
+def parse_sizes(sizes: str) -> list[int]:
+    return [int(size) for size in sizes.split(",")]
+
+
+@click.group()
+def main():
+    pass
+
+
+@main.command()
+@click.option("--data-dir", default="bench_data", help="Directory for generated files")
+@click.option("--sizes", default=SUITE_SIZES, help="Comma separated row counts")
+def generate(data_dir: str, sizes: str) -> None:
+    for rows in parse_sizes(sizes):
+        for path in data_files(data_dir, rows):
+            print(f"{path}  {os.path.getsize(path)} B")
+
+
+@main.command()
+@click.option("--data-dir", default="bench_data", help="Directory for generated files")
+@click.option("--sizes", default=SUITE_SIZES, help="Comma separated row counts")
+@click.option("--only", multiple=True, type=click.Choice(list(BENCHMARKS)), help="Run only these benchmarks")
+@click.option("--output", default="bench_results.json", help="File results are saved to")
+@click.option("--baseline", type=click.Path(exists=True), help="Earlier results to compare with")
+@click.option("--tolerance", default=0.2, help="Allowed slowdown against the baseline, 0.2 = 20%")
+def run(data_dir: str, sizes: str, only: tuple[str], output: str, baseline: str | None, tolerance: float) -> None:
+    results = {"python": platform.python_version(), "machine": platform.machine(), "results": {}}
+    scratch = os.path.join(data_dir, "scratch")
+    os.makedirs(scratch, exist_ok=True)
+    for rows in parse_sizes(sizes):
+        db_file, csv_file = data_files(data_dir, rows)
+        repeats = REPEATS if rows <= REPEAT_UP_TO else 1
+        for name, benchmark in BENCHMARKS.items():
+            if only and name not in only:
+                continue
+            elapsed = time_benchmark(benchmark, db_file, csv_file, scratch, repeats)
+            results["results"].setdefault(name, {})[str(rows)] = elapsed
+            print(f"{name:<20}  {rows:>10}  {elapsed:>9.3f}s")
+    shutil.rmtree(scratch)
+    with open(output, "w", encoding="utf-8") as stream:
+        json.dump(results, stream, indent=2)
+    if baseline is None:
+        return
+    with open(baseline, encoding="utf-8") as stream:
+        slower = compare_results(results, json.load(stream), tolerance)
+    if slower:
+        print(f"Slower than {baseline}: {', '.join(slower)}")
+        sys.exit(1)
+
+
+@main.command()
+@click.option("--sizes", default="10000,100000,1000000", help="Comma separated row counts")
+def ids(sizes: str) -> None:
+    print(f"{'rows':>10}  {'find_next_id':>14}  {'IdAllocator':>12}  {'speedup':>8}")
+    for rows in (int(size) for size in sizes.split(",")):
+        old, estimated = time_find_next_id(rows)
+        new = time_allocator(rows)
+        mark = "~" if estimated else " "
+        print(f"{rows:>10}  {mark}{old:>12.3f}s  {new:>11.3f}s  {old / new:>7.0f}x")
+
+
+@main.command()
+@click.option("--sizes", default="10000,100000,1000000", help="Comma separated row counts")
+def validation(sizes: str) -> None:
+    print(f"{'rows':>10}  {'per row':>10}  {'column':>10}  {'speedup':>8}")
+    for rows in (int(size) for size in sizes.split(",")):
+        amounts = [f"{i % 100000}.{i % 100:02}" for i in range(rows)]
+        descriptions = [f"Row {i}" for i in range(rows)]
+        start = time.perf_counter()
+        [float(LegacyCsvImport(amount, description).amount)
+         for amount, description in zip(amounts, descriptions)]
+        old = time.perf_counter() - start
+        start = time.perf_counter()
+        validate_rows(amounts, descriptions)
+        new = time.perf_counter() - start
+        print(f"{rows:>10}  {old:>9.3f}s  {new:>9.3f}s  {old / new:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,173 @@
 """
-Usage: expense_calculator.py <add (amount, description)> <report> <import-csv(csv path)> <export-python>
+Usage: expense_calculator.py <add (amount, description)> <report> <import-csv(csv paths or globs)> <export-python> <export> <compact>
+                             <migrate (source, target)> <search (words)> <summary> <serve> <cache clear>
 
 Takes arguments to create or add to database budget.json and calculate the sum of expenses. 
 It is possible to load expenses from csv file.
 <export-python> prints budget.db content in the form of a list to be possibly extended).
+<export> writes expenses as they are read, --format ndjson (default), csv or python (the same
+as <export-python>), to stdout or --output file, --gzip compresses the output.
+With --journal, <add> and <import-csv> append to budget.json.journal instead of rewriting
+the database, <compact> folds the journal back into budget.json.
+Databases with .bdb extension are stored in a compact binary format read through mmap,
+.sqlite, .sqlite3 and .db databases are kept in SQLite. <migrate> converts between them.
+A directory database (name ending with /) keeps a json file per month of expense dates and
+manifest.json with the total of each month.
+Expenses can have a date: <add --date YYYY-MM-DD> or a date column in <import-csv> files,
+<report --from/--to> shows only expenses dated within the range (reading only the months
+it covers from a directory database).
+<add --batch> reads "amount<TAB>description" lines from stdin and stores them in one write.
+Writers lock budget.json.lock, with --group-commit concurrent <add> calls are saved together.
+<import-csv> remembers fingerprints of imported rows (with a hash of the file they come from)
+in budget.json.dedup, rows of an export imported again are skipped (--on-duplicate skip,
+default), stop the import (error) or are added again (allow).
+<serve> keeps the database in memory, <add>, <report> and <import-csv> started while it runs
+are sent to it through budget.json.sock, new expenses are saved in the background.
+<summary> prints count, sum, min, max and share of big expenses per description (or per
+description prefix with --by prefix), largest sums first, --top limits number of groups.
+<search (words)> finds expenses by description words or prefixes (word*), optionally within
+--min/--max amounts, using an index in budget.json.search kept up to date by every write.
+--cache (before the command, or EXPENSE_CALCULATOR_CACHE=1) lets read-only commands load a json
+database from budget.json.cache, parsed rows saved by an earlier run and checked against size,
+modification time and hash of the file, <cache clear> removes it.
+--profile (before the command) prints time and peak memory of load, validate, assign ids,
+render and save stages to stderr, --profile-output saves a cProfile or tracemalloc report.
 """
 
-import csv
+from array import array
+import contextlib
+import dataclasses
 from dataclasses import dataclass
+import datetime
+import functools
+import heapq
+import itertools
 import json
+import operator
+import os
+import re
+import struct
 import sys
+import threading
+import time
+from typing import IO, BinaryIO, Callable, Iterable, Iterator, Sequence, TextIO
 import click
+# csv, sqlite3, mmap, glob and concurrent.futures are imported inside the functions
+# needing them, so a plain `add` does not pay for them (see test_import_time).
 
 DB_FILENAME = "budget.json"
+JOURNAL_SUFFIX = ".journal"
+META_SUFFIX = ".meta"
+LOCK_SUFFIX = ".lock"
+QUEUE_SUFFIX = ".queue"
+REJECTS_SUFFIX = ".rejects"
+SOCKET_SUFFIX = ".sock"
+DEDUP_SUFFIX = ".dedup"
+SEARCH_SUFFIX = ".search"
+CACHE_SUFFIX = ".cache"
+# Rows counted at most when guessing which search condition matches the fewest
+SEARCH_ESTIMATE_LIMIT = 50000
+BINARY_SUFFIX = ".bdb"
+SQLITE_SUFFIXES = (".sqlite", ".sqlite3", ".db")
+MANIFEST_FILENAME = "manifest.json"
+UNDATED_PARTITION = "undated"
+# Version 2 keeps totals in cents, aggregates of version 1 are recomputed
+DB_FORMAT_VERSION = 2
+# Version 2 of the binary layout added dates, version 1 files are still read
+BINARY_FORMAT_VERSION = 2
+JOURNAL_COMPACT_THRESHOLD = 1000
+# Version 2 added exact_amounts of ExpenseTable
+PARSE_CACHE_VERSION = 2
+# Bigger parse caches are not written, json is parsed every time instead
+PARSE_CACHE_LIMIT = 512 << 20
+IMPORT_BATCH_SIZE = 10000
+RENDER_CHUNK_LINES = 4096
+SERVED_COMMANDS = ("add", "report", "import-csv")
+DAEMON_PERSIST_INTERVAL = 1.0
+DAEMON_MESSAGE_LIMIT = 1 << 30
+AMOUNT_PATTERN = re.compile(r"\d+(?:\.\d*)?|\.\d+")
+# Bytes of a correct amount column, bytes.translate deletes them to find any other
+AMOUNT_COLUMN_BYTES = b"0123456789.\n"
+# Digits mapped to 0, a dot with three digits after it is then a single substring search
+AMOUNT_DIGITS_TO_ZERO = bytes.maketrans(b"123456789", b"000000000")
+# A digit other than 0 after the second decimal place, i.e. a fraction of a cent
+AMOUNT_SUBCENT = re.compile(r"\.[0-9]{2}[0-9]*[1-9]")
+# Expenses of 1000 and more are big, marked (!) by report
+BIG_EXPENSE_CENTS = 100000
+SEARCH_TOKEN = re.compile(r"\w+")
+PROFILE_STAGES = ("load", "validate", "assign ids", "render", "save")
+
+# Called with stage name, its wall time in seconds (without nested stages) and
+# peak traced memory in bytes, None unless tracemalloc is running.
+TimingHook = Callable[[str, float, "int | None"], None]
+_timing_hooks: list[TimingHook] = []
+# Seconds, peak memory and number of runs of every stage while --profile is on
+_stage_totals: dict[str, list] | None = None
+# Time and peak memory of nested stages, for every stage currently running
+_stage_stack: list[list] = []
+
+
+def register_timing_hook(hook: TimingHook) -> None:
+    """Makes hook receive timing of every stage from now on, e.g. to export it to metrics"""
+    _timing_hooks.append(hook)
+
+
+def unregister_timing_hook(hook: TimingHook) -> None:
+    _timing_hooks.remove(hook)
+
+
+@contextlib.contextmanager
+def profile_stage(name: str) -> Iterator[None]:
+    """Measures a stage (one of PROFILE_STAGES) for --profile and timing hooks.
+    Does nothing when neither is active. Stages running inside another stage
+    are subtracted from its time, so times of all stages add up."""
+    if not _timing_hooks and _stage_totals is None:
+        yield
+        return
+    import tracemalloc
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+    frame = [0.0, 0]  # time and peak memory of nested stages
+    _stage_stack.append(frame)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        _stage_stack.pop()
+        peak = None
+        if tracing:
+            peak = max(tracemalloc.get_traced_memory()[1], frame[1])
+        if _stage_stack:
+            _stage_stack[-1][0] += elapsed
+            _stage_stack[-1][1] = max(_stage_stack[-1][1], peak or 0)
+        record_stage(name, elapsed - frame[0], peak)
+
+
+def record_stage(name: str, seconds: float, peak: int | None) -> None:
+    if _stage_totals is not None:
+        totals = _stage_totals.setdefault(name, [0.0, 0, 0])
+        totals[0] += seconds
+        totals[1] = max(totals[1], peak or 0)
+        totals[2] += 1
+    for hook in _timing_hooks:
+        hook(name, seconds, peak)
+
+
+def print_profile(elapsed: float) -> None:
+    """Prints stage breakdown collected by --profile to stderr"""
+    lines = [f"{'etap':<12}  {'czas':>10}  {'udział':>7}  {'pamięć (szczyt)':>16}  {'wywołania':>10}"]
+    stages = sorted(_stage_totals, key=lambda name: PROFILE_STAGES.index(name)
+                    if name in PROFILE_STAGES else len(PROFILE_STAGES))
+    for name in stages:
+        seconds, peak, calls = _stage_totals[name]
+        share = seconds / elapsed if elapsed else 0.0
+        lines.append(f"{name:<12}  {seconds:>9.3f}s  {share:>7.1%}  {peak / 2 ** 20:>12.1f} MiB  {calls:>10}")
+    other = elapsed - sum(seconds for seconds, _, _ in _stage_totals.values())
+    lines.append(f"{'inne':<12}  {other:>9.3f}s  {other / elapsed if elapsed else 0.0:>7.1%}")
+    lines.append(f"{'razem':<12}  {elapsed:>9.3f}s")
+    click.echo("\n".join(lines), err=True)
 
 
 @dataclass
@@ -20,43 +175,266 @@ class Expense:
     id: int
     amount: float
     description: str
+    date: datetime.date | None = None
 
     def __post_init__(self):
-        if float(self.amount) < 0:
-            raise ValueError("Koszt nie może być ujemny")
-        if float(self.amount) > 10000000000000:
-            raise ValueError("Koszt powinien być mniejszy od 10,000,000,000,000")
-        if not self.description:
-            raise ValueError("Opis nie może być pusty")
+        check_expense(float(self.amount), self.description)
+
+    @property
+    def cents(self) -> int:
+        return to_cents(self.amount)
+
+    @classmethod
+    def trusted(cls, id: int, amount: float, description: str,
+                date: datetime.date | None = None) -> "Expense":
+        """Creates expense from data validated before, skipping __post_init__"""
+        item = object.__new__(cls)
+        item.id = id
+        item.amount = amount
+        item.description = description
+        item.date = date
+        return item
+
+    def __repr__(self):
+        # Undated expenses keep the repr they had before dates, export-python relies on it
+        fields = f"id={self.id!r}, amount={self.amount!r}, description={self.description!r}"
+        if self.date is not None:
+            fields += f", date={self.date!r}"
+        return f"Expense({fields})"
 
     def __post_repr__(self):
         return f"Expense(id={self.id!r}, description={self.description!r}, amount={self.amount!r})"
 
 
+def to_cents(amount: float | str) -> int:
+    """Amount as a whole number of cents, the fixed point form totals are
+    summed in. Fractions of a cent (only in databases of older versions) are
+    rounded half up, as SQLite ROUND does.
+    Example:
+    >>> to_cents(0.29), to_cents("12.5"), to_cents(0.125)
+    (29, 1250, 13) """
+    return int(float(amount) * 100 + 0.5)
+
+
+def format_cents(cents: int) -> str:
+    """Amount in cents as shown to the user, without trailing zeroes
+    (the same text strip_zeros gives for the float amount).
+    Example:
+    >>> format_cents(1250), format_cents(1205), format_cents(300)
+    ('12.5', '12.05', '3') """
+    whole, fraction = divmod(cents, 100)
+    if not fraction:
+        return str(whole)
+    if fraction % 10:
+        return f"{whole}.{fraction:02}"
+    return f"{whole}.{fraction // 10}"
+
+
+def format_amount(amount: float, cents: int) -> str:
+    """Amount of a row as shown to the user, cents being to_cents(amount).
+    Fractions of a cent of databases of older versions are shown as stored."""
+    if cents / 100 == amount:
+        return format_cents(cents)
+    return str(amount)
+
+
+def check_expense(amount: float, description: str) -> None:
+    """Raises ValueError with the message for the user if expense data is incorrect"""
+    if amount < 0:
+        raise ValueError("Koszt nie może być ujemny")
+    if amount > 10000000000000:
+        raise ValueError("Koszt powinien być mniejszy od 10,000,000,000,000")
+    if not description:
+        raise ValueError("Opis nie może być pusty")
+
+
 @dataclass
 class CSV_import:
     amount: float|str
     description: str
 
     def __post_init__(self):
-        if self.amount[0] == "-":
-            raise ValueError("Koszt nie może być ujemny")
-        if "." not in self.amount:
-            if not self.amount.isnumeric():
-                raise ValueError("Wszystkie koszty muszą być liczbami")
-        else:
-            counter = 0
-            for each in self.amount:
-                if each == ".":
-                    counter += 1
-                    if counter > 1:
-                        raise ValueError("Wszystkie koszty muszą być liczbami")
-                elif not each.isnumeric():
-                    raise ValueError("Wszystkie koszty muszą być liczbami")
-
+        message = amount_error(self.amount)
+        if message:
+            raise ValueError(message)
         if not self.description:
             raise ValueError("Opis nie może być pusty")
 
+    @property
+    def cents(self) -> int:
+        return to_cents(self.amount)
+
+
+class CsvRowError(ValueError):
+    """Validation error of a csv row, args are (message, row number in the file[, file name])"""
+
+    @property
+    def row(self) -> int:
+        return self.args[1]
+
+
+SUBCENT_ERROR = "Koszt może mieć najwyżej dwie cyfry po przecinku"
+
+
+def amount_error(amount: str) -> str | None:
+    """Returns the error message for an incorrect csv amount or None if it is fine"""
+    if amount and amount[0] == "-":
+        return "Koszt nie może być ujemny"
+    if not isinstance(amount, str) or not AMOUNT_PATTERN.fullmatch(amount):
+        return "Wszystkie koszty muszą być liczbami"
+    if AMOUNT_SUBCENT.search(amount):
+        return SUBCENT_ERROR
+    return None
+
+
+def is_valid_amount_column(column: str, rows: int) -> bool:
+    """Tells if the column of `rows` amounts joined with line breaks has only
+    ASCII digits and dots in its values and no fractions of a cent. Together
+    with float() accepting the values (not empty, not a lone dot, at most one
+    dot) this is AMOUNT_PATTERN for every row. Each check is a single C-level
+    pass over the bytes of the column, the subcent regex runs only when some
+    value has three decimals (e.g. 12.340).
+    Raises UnicodeEncodeError (a ValueError) for non-ASCII characters."""
+    data = column.encode("ascii")
+    return (data.count(b"\n") == rows - 1
+            and not data.translate(None, AMOUNT_COLUMN_BYTES)
+            and (b".000" not in data.translate(AMOUNT_DIGITS_TO_ZERO) or AMOUNT_SUBCENT.search(column) is None))
+
+
+def validate_amounts(amounts: list[str], first_row: int = 1) -> list[float]:
+    """Checks and converts a whole column of csv amounts.
+    Correct columns are checked on the joined column with a few C-level scans
+    (see is_valid_amount_column) and converted by one map(float), only a
+    failing column is walked row by row to find the first bad value.
+    Example:
+    >>> validate_amounts(["10", "2.5"])
+    [10.0, 2.5] """
+    try:
+        if is_valid_amount_column("\n".join(amounts), len(amounts)):
+            return list(map(float, amounts))
+    except (TypeError, ValueError):
+        # Missing, non-ASCII or malformed values (e.g. "1.2.3"), handled below.
+        pass
+    for row, amount in enumerate(amounts, first_row):
+        message = amount_error(amount)
+        if message:
+            raise CsvRowError(message, row)
+    return list(map(float, amounts))
+
+
+def validate_rows(amounts: list[str], descriptions: list[str], first_row: int = 1) -> list[float]:
+    """Validates amounts and descriptions of csv rows, the first incorrect row wins"""
+    empty_row = None
+    if not all(descriptions):
+        empty_row = next(itertools.compress(
+            itertools.count(first_row), map(operator.not_, descriptions)))
+    try:
+        values = validate_amounts(amounts, first_row)
+    except CsvRowError as error:
+        # On the same row the amount is reported, as CSV_import checks it first
+        if empty_row is None or error.row <= empty_row:
+            raise
+    if empty_row is not None:
+        raise CsvRowError("Opis nie może być pusty", empty_row)
+    return values
+
+
+def parse_date(text: str) -> datetime.date:
+    """Converts a YYYY-MM-DD date of the user, a csv file or a database"""
+    try:
+        return datetime.date.fromisoformat(text)
+    except (TypeError, ValueError):
+        raise ValueError("Data musi mieć postać RRRR-MM-DD") from None
+
+
+def record_date(record: dict) -> datetime.date | None:
+    """Date of a json record, records of undated expenses have no date key"""
+    text = record.get("date")
+    return None if text is None else parse_date(text)
+
+
+def expense_record(item: Expense) -> dict:
+    """Json record of an expense, as stored in databases and journals"""
+    record = {"id": item.id, "amount": float(item.amount), "description": item.description}
+    if item.date is not None:
+        record["date"] = item.date.isoformat()
+    return record
+
+
+def date_ordinal(date: datetime.date | None) -> int:
+    """Date as stored in typed arrays and binary records, 0 for no date"""
+    return 0 if date is None else date.toordinal()
+
+
+def ordinal_date(ordinal: int) -> datetime.date | None:
+    return datetime.date.fromordinal(ordinal) if ordinal else None
+
+
+def has_dates(expenses: Iterable[Expense]) -> bool:
+    """Tells if any expense is dated, tables answer from their date column"""
+    if isinstance(expenses, (ExpenseTable, BinaryExpenses)):
+        return any(expenses.dates)
+    return any(item.date is not None for item in expenses)
+
+
+def validate_dates(dates: list[str], first_row: int = 1) -> list[datetime.date | None]:
+    """Parses the optional date column of csv rows, rows with an empty date are undated"""
+    parsed = []
+    for row, text in enumerate(dates, first_row):
+        try:
+            parsed.append(parse_date(text) if text else None)
+        except ValueError as error:
+            raise CsvRowError(error.args[0], row) from None
+    return parsed
+
+
+def format_error(error: ValueError) -> str:
+    if isinstance(error, CsvRowError) and len(error.args) > 2:
+        return f"{error.args[0]} ({error.args[2]}, wiersz {error.row})"
+    if isinstance(error, CsvRowError):
+        return f"{error.args[0]} (wiersz {error.row})"
+    return error.args[0]
+
+
+@dataclass
+class ExpenseStats:
+    """Aggregates used by report, kept up to date as expenses are added.
+    extra_space is the widening of the amount column needed by amounts of
+    10,000,000 and more, big_count is the number of rows marked (!).
+    The total is summed in cents, so it is exact however many rows there are."""
+    count: int = 0
+    cents: int = 0
+    big_count: int = 0
+    extra_space: int = 0
+
+    @property
+    def total(self) -> float:
+        return self.cents / 100
+
+    def add(self, item: Expense) -> None:
+        amount = item.amount
+        self.count += 1
+        cents = to_cents(amount)
+        self.cents += cents
+        if cents >= BIG_EXPENSE_CENTS:
+            self.big_count += 1
+        if amount >= 10000000:
+            self.extra_space = max(self.extra_space, len(str(amount)) - 8)
+
+    def merge(self, other: "ExpenseStats") -> None:
+        """Adds aggregates of other expenses, e.g. of another partition"""
+        self.count += other.count
+        self.cents += other.cents
+        self.big_count += other.big_count
+        self.extra_space = max(self.extra_space, other.extra_space)
+
+    @classmethod
+    def from_expenses(cls, expenses: Iterable[Expense]) -> "ExpenseStats":
+        stats = cls()
+        for item in expenses:
+            stats.add(item)
+        return stats
+
 
 def find_next_id(expense_list: list[Expense]):
     """Used to help organize data in a database - 
@@ -72,32 +450,1632 @@ def find_next_id(expense_list: list[Expense]):
     return counter
 
 
-def read_db_or_init(filename=DB_FILENAME) -> list[Expense]:
-    "Loads data from a database and returns empty list if database is not found."
+class IdAllocator:
+    """Hands out the same ids as find_next_id, but without rescanning the list.
+    Free gaps are kept as a heap of (start, end) ranges, everything from
+    next_free upwards is unused. Each allocation is O(log gaps).
+    Example:
+    >>> allocator = IdAllocator([Expense(id=1, ...), Expense(id=3, ...)])
+    >>> allocator.next_id(), allocator.next_id()
+    (2, 4) """
+
+    def __init__(self, expense_list: list[Expense] = ()):
+        self.gaps: list[tuple[int, int]] = []
+        self.next_free = 1
+        self.add_taken_ids(item.id for item in expense_list)
+
+    @classmethod
+    def from_ids(cls, ids: Iterable[int]) -> "IdAllocator":
+        allocator = cls()
+        allocator.add_taken_ids(ids)
+        return allocator
+
+    def add_taken_ids(self, ids: Iterable[int]) -> None:
+        previous = 0
+        for current in sorted(set(ids)):
+            if current <= 0:
+                continue
+            if current > previous + 1:
+                self.gaps.append((previous + 1, current - 1))
+            previous = current
+        self.next_free = previous + 1
+
+    def next_id(self) -> int:
+        if self.gaps:
+            start, end = self.gaps[0]
+            if start == end:
+                heapq.heappop(self.gaps)
+            else:
+                heapq.heapreplace(self.gaps, (start + 1, end))
+            return start
+        self.next_free += 1
+        return self.next_free - 1
+
+    def claim(self, taken_id: int) -> None:
+        """Marks an id that was assigned elsewhere (e.g. replayed from a journal) as used"""
+        if taken_id >= self.next_free:
+            if taken_id > self.next_free:
+                heapq.heappush(self.gaps, (self.next_free, taken_id - 1))
+            self.next_free = taken_id + 1
+            return
+        for index, (start, end) in enumerate(self.gaps):
+            if start <= taken_id <= end:
+                self.gaps[index:index + 1] = [
+                    (low, high) for low, high in ((start, taken_id - 1), (taken_id + 1, end))
+                    if low <= high]
+                heapq.heapify(self.gaps)
+                return
+
+    def to_state(self) -> dict:
+        return {"gaps": [list(gap) for gap in sorted(self.gaps)], "next_free": self.next_free}
+
+    @classmethod
+    def from_state(cls, state: dict) -> "IdAllocator":
+        allocator = cls()
+        allocator.gaps = [tuple(gap) for gap in state["gaps"]]
+        heapq.heapify(allocator.gaps)
+        allocator.next_free = state["next_free"]
+        return allocator
+
+
+class ExpenseTable:
+    """Read-mostly column store of expenses for big databases.
+    Ids, amounts (in cents) and dates (as ordinals, 0 for none) live in typed arrays,
+    descriptions are interned - every
+    distinct text is kept once and rows hold its index. Iteration yields Expense
+    items created on the fly, repr is the same as repr of a list of expenses.
+    Amounts which are not whole cents (possible in databases of older versions)
+    are also kept as they were in exact_amounts, by row, so rows read back the same.
+    Example:
+    >>> table = ExpenseTable([Expense(1, 34.0, "Kawa"), Expense(2, 1200.0, "Kawa")])
+    >>> table.total(), len(table.descriptions)
+    (1234.0, 1) """
+
+    def __init__(self, expenses: Iterable[Expense] = ()):
+        self.ids = array("q")
+        self.cents = array("q")
+        self.description_codes = array("q")
+        self.dates = array("i")
+        self.descriptions: list[str] = []
+        self.description_index: dict[str, int] = {}
+        self.exact_amounts: dict[int, float] = {}
+        for item in expenses:
+            self.append(item)
+
+    def add_row(self, id: int, amount: float, description: str, date_ordinal: int = 0) -> None:
+        cents = int(amount * 100 + 0.5)
+        if cents / 100 != amount:
+            self.exact_amounts[len(self.ids)] = amount
+        code = self.description_index.get(description)
+        if code is None:
+            code = self.description_index[description] = len(self.descriptions)
+            self.descriptions.append(description)
+        self.ids.append(id)
+        self.cents.append(cents)
+        self.description_codes.append(code)
+        self.dates.append(date_ordinal)
+
+    def append(self, item: Expense) -> None:
+        self.add_row(item.id, float(item.amount), item.description, date_ordinal(item.date))
+
+    def amount(self, index: int) -> float:
+        if self.exact_amounts and index in self.exact_amounts:
+            return self.exact_amounts[index]
+        return self.cents[index] / 100
+
+    def row(self, index: int) -> Expense:
+        # Data in the table was validated when added
+        return Expense.trusted(self.ids[index], self.amount(index),
+                               self.descriptions[self.description_codes[index]],
+                               ordinal_date(self.dates[index]))
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __iter__(self) -> Iterator[Expense]:
+        return map(self.row, range(len(self.ids)))
+
+    def __getitem__(self, index: int | slice) -> Expense | list[Expense]:
+        if isinstance(index, slice):
+            return [self.row(position) for position in range(*index.indices(len(self.ids)))]
+        return self.row(range(len(self.ids))[index])
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, (ExpenseTable, list)):
+            return len(self) == len(other) and all(map(operator.eq, self, other))
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"[{', '.join(map(repr, self))}]"
+
+    def total_cents(self) -> int:
+        return sum(self.cents)
+
+    def total(self) -> float:
+        return self.total_cents() / 100
+
+    def max_amount(self) -> float:
+        return max(self.cents, default=0) / 100
+
+    def filter(self, min_amount: float | None = None, max_amount: float | None = None,
+               text: str | None = None) -> "ExpenseTable":
+        """Rows with amount in [min_amount, max_amount] and text inside description"""
+        masks = []
+        if min_amount is not None:
+            masks.append(map(functools.partial(operator.le, min_amount * 100), self.cents))
+        if max_amount is not None:
+            masks.append(map(functools.partial(operator.ge, max_amount * 100), self.cents))
+        if text is not None:
+            matching_codes = {code for code, description in enumerate(self.descriptions)
+                              if text in description}
+            masks.append(map(matching_codes.__contains__, self.description_codes))
+        selected = itertools.compress(range(len(self.ids)), map(all, zip(*masks)) if masks
+                                      else itertools.repeat(True))
+        return self.select(selected)
+
+    def between(self, start: datetime.date | None = None, end: datetime.date | None = None) -> "ExpenseTable":
+        """Rows dated from start to end, both included and both optional.
+        Undated rows are left out."""
+        low, high = date_ordinal(start) or 1, date_ordinal(end) or datetime.date.max.toordinal()
+        return self.select(itertools.compress(range(len(self.ids)), map(
+            functools.partial(operator.contains, range(low, high + 1)), self.dates)))
+
+    def select(self, positions: Iterable[int]) -> "ExpenseTable":
+        table = ExpenseTable()
+        for index in positions:
+            table.add_row(self.ids[index], self.amount(index),
+                          self.descriptions[self.description_codes[index]], self.dates[index])
+        return table
+
+
+@dataclass
+class GroupSummary:
+    """Aggregates of expenses sharing a description (or its prefix)"""
+    key: str
+    count: int
+    total: float
+    min_amount: float
+    max_amount: float
+    big_count: int
+
+    @property
+    def big_share(self) -> float:
+        return self.big_count / self.count
+
+
+def description_groups(descriptions: list[str], words: int | None = None) -> tuple[list[str], list[int]]:
+    """Returns group keys and the group of every description. Without words
+    each description is its own group, otherwise descriptions are grouped by
+    their first `words` words, lowercased and without punctuation."""
+    if words is None:
+        return descriptions, list(range(len(descriptions)))
+    keys, key_index, groups = [], {}, []
+    for description in descriptions:
+        key = " ".join(search_tokens(description)[:words]) or description.strip().lower()
+        group = key_index.get(key)
+        if group is None:
+            group = key_index[key] = len(keys)
+            keys.append(key)
+        groups.append(group)
+    return keys, groups
+
+
+def summarize_groups(table: ExpenseTable, words: int | None = None) -> list[GroupSummary]:
+    """Summaries of description groups (see description_groups) in the order
+    the groups first appear. Rows are never visited one by one in Python:
+    with numpy installed every aggregate is a single vectorized pass over
+    the column of cents, otherwise rows are ordered by group and each group
+    is aggregated by builtins. Totals are summed as integers, so they are exact."""
+    keys, group_of_description = description_groups(table.descriptions, words)
+    if not len(table):
+        return []
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    if numpy is None:
+        groups = list(map(group_of_description.__getitem__, table.description_codes))
+        order = sorted(range(len(groups)), key=groups.__getitem__)
+        summaries = []
+        for group, positions in itertools.groupby(order, key=groups.__getitem__):
+            cents = list(map(table.cents.__getitem__, positions))
+            big_count = sum(map(functools.partial(operator.le, BIG_EXPENSE_CENTS), cents))
+            summaries.append(GroupSummary(keys[group], len(cents), sum(cents) / 100, min(cents) / 100,
+                                          max(cents) / 100, big_count))
+        return summaries
+    cents = numpy.frombuffer(table.cents, dtype=numpy.int64)
+    groups = numpy.asarray(group_of_description, dtype=numpy.int64)[
+        numpy.frombuffer(table.description_codes, dtype=numpy.int64)]
+    counts = numpy.bincount(groups, minlength=len(keys))
+    big_counts = numpy.bincount(groups, weights=cents >= BIG_EXPENSE_CENTS, minlength=len(keys))
+    present = numpy.flatnonzero(counts)
+    # Cents ordered by group, every group is one segment for reduceat.
+    # bincount would sum in float64, int64 segment sums stay exact.
+    grouped_cents = cents[numpy.argsort(groups, kind="stable")]
+    starts = numpy.concatenate(([0], numpy.cumsum(counts[present])[:-1]))
+    totals = numpy.add.reduceat(grouped_cents, starts)
+    minimums = numpy.minimum.reduceat(grouped_cents, starts)
+    maximums = numpy.maximum.reduceat(grouped_cents, starts)
+    return [GroupSummary(keys[group], int(counts[group]), total / 100, minimum / 100,
+                         maximum / 100, int(big_counts[group]))
+            for group, total, minimum, maximum in zip(present.tolist(), totals.tolist(),
+                                                      minimums.tolist(), maximums.tolist())]
+
+
+def is_binary_db(filename=DB_FILENAME) -> bool:
+    return filename.endswith(BINARY_SUFFIX)
+
+
+class BinaryExpenses:
+    """Read-only view of a binary database, rows are decoded from a memory map on access.
+    File layout (little endian):
+        header       magic b"BDGT", format version (u32), row count (u64), records offset (u64)
+        descriptions utf-8 texts one after another
+        records      id (i64), amount (f64), description offset (u64) and length (u32),
+                     date ordinal (i32, 0 for none - not in version 1 files) per row
+    Example:
+    >>> expenses = BinaryExpenses("budget.bdb")
+    >>> expenses[0]
+    Expense(id=1, amount=34.0, description='Hit Box') """
+
+    HEADER = struct.Struct("<4sIQQ")
+    RECORD = struct.Struct("<qdQIi")
+    RECORDS = {1: struct.Struct("<qdQI"), BINARY_FORMAT_VERSION: RECORD}
+    MAGIC = b"BDGT"
+
+    def __init__(self, filename: str):
+        with open(filename, "rb") as stream:
+            import mmap
+            self.data = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data.size() < self.HEADER.size:
+            raise ValueError("Niepoprawny plik bazy danych")
+        magic, version, self.count, self.records_offset = self.HEADER.unpack_from(self.data)
+        if magic != self.MAGIC or version not in self.RECORDS:
+            raise ValueError("Niepoprawny plik bazy danych")
+        self.record = self.RECORDS[version]
+
+    @classmethod
+    def open_or_empty(cls, filename: str) -> "BinaryExpenses | ExpenseTable":
+        try:
+            return cls(filename)
+        except FileNotFoundError:
+            return ExpenseTable()
+
+    def records(self) -> Iterator[tuple[int, float, int, int] | tuple[int, float, int, int, int]]:
+        end = self.records_offset + self.count * self.record.size
+        return self.record.iter_unpack(memoryview(self.data)[self.records_offset:end])
+
+    @functools.cached_property
+    def ids(self) -> array:
+        return array("q", (record[0] for record in self.records()))
+
+    @functools.cached_property
+    def cents(self) -> array:
+        return array("q", (to_cents(record[1]) for record in self.records()))
+
+    @functools.cached_property
+    def dates(self) -> array:
+        if self.record is not self.RECORD:
+            return array("i", bytes(self.count * 4))
+        return array("i", (record[4] for record in self.records()))
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __iter__(self) -> Iterator[Expense]:
+        data = self.data
+        for id, amount, offset, length, *ordinal in self.records():
+            yield Expense.trusted(id, amount, data[offset:offset + length].decode("utf-8"),
+                                  ordinal_date(ordinal[0]) if ordinal else None)
+
+    def __getitem__(self, index: int) -> Expense:
+        index = range(self.count)[index]
+        id, amount, offset, length, *ordinal = self.record.unpack_from(
+            self.data, self.records_offset + index * self.record.size)
+        return Expense.trusted(id, amount, self.data[offset:offset + length].decode("utf-8"),
+                               ordinal_date(ordinal[0]) if ordinal else None)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, (BinaryExpenses, ExpenseTable, list)):
+            return len(self) == len(other) and all(map(operator.eq, self, other))
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"[{', '.join(map(repr, self))}]"
+
+    def total_cents(self) -> int:
+        return sum(self.cents)
+
+    def total(self) -> float:
+        return self.total_cents() / 100
+
+    def max_amount(self) -> float:
+        return max(self.cents, default=0) / 100
+
+
+def write_binary_records(stream: BinaryIO, batches: Iterable[list[Expense]]) -> None:
+    """Writes expenses in the BinaryExpenses layout. Descriptions are streamed
+    to the file, the fixed-width records are collected and appended at the end."""
+    header, record = BinaryExpenses.HEADER, BinaryExpenses.RECORD
+    stream.write(bytes(header.size))
+    position = header.size
+    records = bytearray()
+    count = 0
+    for batch in batches:
+        texts = [item.description.encode("utf-8") for item in batch]
+        for item, text in zip(batch, texts):
+            records += record.pack(item.id, float(item.amount), position, len(text), date_ordinal(item.date))
+            position += len(text)
+        stream.write(b"".join(texts))
+        count += len(batch)
+    stream.write(records)
+    stream.seek(0)
+    stream.write(header.pack(BinaryExpenses.MAGIC, BINARY_FORMAT_VERSION, count, position))
+
+
+def write_db_file(filename: str, batches: Iterable[list[Expense]], mode: str = "w",
+                  binary: bool = False, sync: bool = False) -> None:
+    """Writes expense batches as json or, with binary=True, in the binary layout.
+    With sync=True the file is on disk (fsync) before it is closed."""
+    with (open(filename, mode + "b") if binary else open(filename, mode, encoding="utf-8")) as stream:
+        if binary:
+            write_binary_records(stream, batches)
+        else:
+            write_json_records(stream, batches)
+        if sync:
+            stream.flush()
+            os.fsync(stream.fileno())
+
+
+def replace_db_file(filename: str, batches: Iterable[list[Expense]], binary: bool = False) -> None:
+    """Writes the batches next to the database and moves the result over it,
+    so readers see either the old or the new file, never a partial one.
+    The new file is synced before the move, so after a crash the database is
+    the old or the complete new file, not an empty one.
+    The database is left untouched if producing the batches raises."""
+    temp_file = filename + ".tmp"
+    try:
+        write_db_file(temp_file, batches, binary=binary, sync=True)
+    except BaseException:
+        os.remove(temp_file)
+        raise
+    os.replace(temp_file, filename)
+
+
+def lock_stream(stream: IO, unlock: bool = False) -> None:
+    """Blocks until the exclusive advisory lock of an open file is taken (or releases it)"""
+    try:
+        import fcntl
+    except ImportError:
+        import msvcrt
+        stream.seek(0)
+        msvcrt.locking(stream.fileno(), msvcrt.LK_UNLCK if unlock else msvcrt.LK_LOCK, 1)
+        return
+    fcntl.flock(stream.fileno(), fcntl.LOCK_UN if unlock else fcntl.LOCK_EX)
+
+
+@contextlib.contextmanager
+def locked_file(path: str) -> Iterator[BinaryIO]:
+    """Opens path for appending and reading, holding its lock until closed"""
+    with open(path, "a+b") as stream:
+        lock_stream(stream)
+        try:
+            yield stream
+        finally:
+            # Buffered writes must reach the file while it is still locked
+            stream.flush()
+            lock_stream(stream, unlock=True)
+
+
+def lock_path(filename=DB_FILENAME) -> str:
+    return filename + LOCK_SUFFIX
+
+
+_held_db_locks: set[str] = set()
+
+
+@contextlib.contextmanager
+def lock_db(filename=DB_FILENAME) -> Iterator[None]:
+    """Serializes writers of one database through an advisory lock of
+    <filename>.lock, held for the whole read-modify-write. Taking it again
+    in the process already holding it does nothing, so locked operations
+    can call each other. Readers do not lock: files are replaced atomically."""
+    path = os.path.abspath(lock_path(filename))
+    if path in _held_db_locks:
+        yield
+        return
+    with locked_file(path):
+        _held_db_locks.add(path)
+        try:
+            yield
+        finally:
+            _held_db_locks.discard(path)
+
+
+def db_meta_path(filename=DB_FILENAME) -> str:
+    return filename + META_SUFFIX
+
+
+def write_db_meta(filename=DB_FILENAME, stats: ExpenseStats | None = None) -> None:
+    """Records format version, size and modification time of a database just
+    written by this program. As long as they match, the file is known to hold
+    validated data and its aggregates can be trusted."""
+    stat = os.stat(filename)
+    meta = {"format_version": DB_FORMAT_VERSION, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if stats is not None:
+        meta["stats"] = dataclasses.asdict(stats)
+    with open(db_meta_path(filename), "w", encoding="utf-8") as stream:
+        stream.write(json.dumps(meta))
+
+
+def read_db_meta(filename=DB_FILENAME) -> dict | None:
+    """Returns metadata written by write_db_meta or None when there is none or
+    the database was changed by something else (hand edits, other programs)."""
+    try:
+        with open(db_meta_path(filename), encoding="utf-8") as stream:
+            meta = json.loads(stream.read())
+        stat = os.stat(filename)
+    except (OSError, ValueError):
+        return None
+    if (not isinstance(meta, dict) or meta.get("format_version") != DB_FORMAT_VERSION
+            or meta.get("size") != stat.st_size or meta.get("mtime_ns") != stat.st_mtime_ns):
+        return None
+    return meta
+
+
+def replay_journal(filename=DB_FILENAME, snapshot_ids: Iterable[int] = ()) -> list[Expense]:
+    """Expenses from the journal which are not in the snapshot yet"""
+    if not os.path.exists(journal_path(filename)):
+        return []
+    # Ids already in the snapshot mean compaction was interrupted after
+    # the snapshot had been written, so those records must not be doubled.
+    snapshot_ids = set(snapshot_ids)
+    _, journal_records = read_journal(filename)
+    return [item for item in journal_records if item.id not in snapshot_ids]
+
+
+def read_json_table(filename: str, trusted: bool = False, table: ExpenseTable | None = None) -> ExpenseTable:
+    """Rows of a json database file added to table (a new one by default).
+    Records are moved into the table while json is parsed, so neither per-row
+    dicts nor Expense items are kept around. Untrusted files are validated.
+    A missing file has no rows."""
+    table = ExpenseTable() if table is None else table
+
+    def add_record(item: dict) -> None:
+        amount = float(item["amount"])
+        check_expense(amount, item["description"])
+        table.add_row(item["id"], amount, item["description"], date_ordinal(record_date(item)))
+
+    def add_trusted_record(item: dict) -> None:
+        date = item.get("date")
+        table.add_row(item["id"], item["amount"], item["description"],
+                      0 if date is None else datetime.date.fromisoformat(date).toordinal())
+
     try:
         with open(filename, "rb") as stream:
-            expense_list_data = json.load(stream)
-            expense_list = [Expense(item["id"], float(item["amount"]), item["description"])
-                for item in expense_list_data]
+            json.load(stream, object_hook=add_trusted_record if trusted else add_record)
     except FileNotFoundError:
-        expense_list = []
-    return expense_list
+        pass
+    return table
+
+
+# Set by --cache (or EXPENSE_CALCULATOR_CACHE=1) of the command line
+_parse_cache_enabled = False
+
 
+def parse_cache_path(filename=DB_FILENAME) -> str:
+    return filename + CACHE_SUFFIX
 
-def save_db(expense_list: list[Expense], filename=DB_FILENAME, overwrite: bool = True) -> None:
-    mode = "w" if overwrite else "x"
-    expense_list_data = [
-        {"id": item.id, "amount": item.amount, "description": item.description}
-        for item in expense_list]
-    with open(filename, mode, encoding="utf-8") as stream:
-        json.dump(expense_list_data, stream, indent=2)
 
+def parse_cache_key(filename: str, digest: bool = True) -> dict | None:
+    """What a parse cache is valid for: path, size, modification time and
+    (with digest) blake2b hash of the database file, None when there is no file"""
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    key = {"version": PARSE_CACHE_VERSION, "path": os.path.abspath(filename),
+           "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if digest:
+        key["hash"] = file_digest(filename)
+    return key
+
+
+def read_parse_cache(filename=DB_FILENAME) -> ExpenseTable | None:
+    """Rows of a json database from its parse cache, None when there is no
+    cache or it was made from another version of the file"""
+    import marshal
+    try:
+        with open(parse_cache_path(filename), "rb") as stream:
+            key = marshal.load(stream)
+            # Size and time are compared first, the file is hashed only if they match
+            stat_key = parse_cache_key(filename, digest=False)
+            if (not isinstance(key, dict) or stat_key is None or not stat_key.items() <= key.items()
+                    or key != parse_cache_key(filename)):
+                return None
+            ids, cents, description_codes, dates, descriptions, exact_amounts = marshal.load(stream)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    table = ExpenseTable()
+    table.ids.frombytes(ids)
+    table.cents.frombytes(cents)
+    table.description_codes.frombytes(description_codes)
+    table.dates.frombytes(dates)
+    table.descriptions = descriptions
+    table.description_index = {description: code for code, description in enumerate(descriptions)}
+    table.exact_amounts = exact_amounts
+    return table
+
+
+def write_parse_cache(filename: str, table: ExpenseTable, key: dict) -> None:
+    """Saves rows parsed from the database in the marshal format, which loads
+    without running any code. Nothing is written above PARSE_CACHE_LIMIT."""
+    import marshal
+    columns = (table.ids, table.cents, table.description_codes, table.dates)
+    size = sum(column.itemsize * len(column) for column in columns) + sum(map(len, table.descriptions))
+    if size > PARSE_CACHE_LIMIT:
+        remove_parse_cache(filename)
+        return
+    path = parse_cache_path(filename)
+    temp_file = path + ".tmp"
+    with open(temp_file, "wb") as stream:
+        marshal.dump(key, stream)
+        marshal.dump((*(column.tobytes() for column in columns), table.descriptions, table.exact_amounts), stream)
+    os.replace(temp_file, path)
+
+
+def remove_parse_cache(filename=DB_FILENAME) -> bool:
+    """Removes the parse cache of the database, tells if there was one"""
+    try:
+        os.remove(parse_cache_path(filename))
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def read_cached_json_table(filename: str, trusted: bool = False) -> ExpenseTable:
+    """read_json_table going through the parse cache of the database.
+    The parsed rows are cached only if the file was not replaced meanwhile."""
+    table = read_parse_cache(filename)
+    if table is not None:
+        return table
+    key = parse_cache_key(filename)
+    table = read_json_table(filename, trusted)
+    stat_key = parse_cache_key(filename, digest=False)
+    if key is not None and stat_key is not None and stat_key.items() <= key.items():
+        try:
+            write_parse_cache(filename, table, key)
+        except OSError:
+            # A read-only directory only means no cache
+            pass
+    return table
+
+
+class ExpenseStorage:
+    """Interface of database backends, open_storage picks one by filename.
+    Public functions (read_db_or_init, save_db, add_csv_to_db, ...) and commands
+    go through it, so a backend only has to provide these methods."""
+
+    supports_journal = False
+
+    def __init__(self, filename: str = DB_FILENAME):
+        self.filename = filename
+
+    def lock(self) -> contextlib.AbstractContextManager:
+        """Held by read-modify-write operations, backends with their own
+        transactions do not need it"""
+        return contextlib.nullcontext()
+
+    def load(self) -> list[Expense]:
+        """All expenses as a list which can be modified and saved back"""
+        raise NotImplementedError
+
+    def load_table(self) -> "Sequence[Expense]":
+        """All expenses for read-only use, in a compact form if the backend has one"""
+        return ExpenseTable(self.load())
+
+    def save(self, expense_list: list[Expense], overwrite: bool = True,
+             stats: ExpenseStats | None = None) -> None:
+        """Replaces the whole database, FileExistsError if it exists and overwrite is False"""
+        raise NotImplementedError
+
+    def stats(self) -> ExpenseStats | None:
+        """Aggregates of the database if they can be had without reading every row"""
+        return None
+
+    def load_range(self, start: datetime.date | None = None,
+                   end: datetime.date | None = None) -> "Sequence[Expense]":
+        """Expenses dated from start to end (both included, either can be None),
+        for read-only use. Undated expenses are left out."""
+        table = self.load_table()
+        return (table if isinstance(table, ExpenseTable) else ExpenseTable(table)).between(start, end)
+
+    def range_stats(self, start: datetime.date | None = None,
+                    end: datetime.date | None = None) -> ExpenseStats:
+        """Aggregates of the expenses of load_range"""
+        return ExpenseStats.from_expenses(self.load_range(start, end))
+
+    def add(self, amount: float, description: str, date: datetime.date | None = None) -> Expense:
+        with self.lock(), search_index_writer(self.filename) as index_rows:
+            expense_list = self.load()
+            stats = self.stats()
+            with profile_stage("assign ids"):
+                add_expense(expense_list, amount, description, stats=stats, date=date)
+            self.save(expense_list, stats=stats)
+            index_rows(expense_list[-1:])
+        return expense_list[-1]
+
+    def add_many(self, rows: list[tuple[float, str, datetime.date | None]]) -> list[Expense]:
+        """Adds many (amount, description, date) rows with a single load and save of the database"""
+        added = []
+
+        def make_batches(allocator: IdAllocator, stats: ExpenseStats) -> Iterator[list[Expense]]:
+            with profile_stage("assign ids"):
+                for amount, description, date in rows:
+                    add_expense(added, amount, description, allocator, stats, date)
+            yield added
+
+        self.import_batches(make_batches)
+        return added
+
+    def import_batches(self, make_batches: Callable[[IdAllocator, ExpenseStats], Iterable[list[Expense]]]
+                       ) -> None:
+        """Adds all batches produced by make_batches(allocator, stats) in one go,
+        the database is left untouched if producing them raises."""
+        raise NotImplementedError
+
+    def append(self, expenses: list[Expense]) -> None:
+        """Stores expenses which already have ids, not used by the database yet"""
+        def make_batches(allocator: IdAllocator, stats: ExpenseStats) -> Iterator[list[Expense]]:
+            for item in expenses:
+                stats.add(item)
+            yield expenses
+
+        self.import_batches(make_batches)
+
+
+class FileStorage(ExpenseStorage):
+    """Json (default) or binary (.bdb) database file with the optional journal next to it"""
+
+    supports_journal = True
+
+    def lock(self) -> contextlib.AbstractContextManager:
+        return lock_db(self.filename)
+
+    def load(self) -> list[Expense]:
+        """Loads data from a database and returns empty list if database is not found.
+        Records appended to the journal since the last compaction are replayed on top.
+        Files untouched since save_db (see read_db_meta) are not validated again."""
+        with profile_stage("load"):
+            filename = self.filename
+            if is_binary_db(filename):
+                expense_list = list(BinaryExpenses.open_or_empty(filename))
+                expense_list.extend(replay_journal(filename, (item.id for item in expense_list)))
+                return expense_list
+            try:
+                trusted = read_db_meta(filename) is not None
+                with open(filename, "rb") as stream:
+                    expense_list_data = json.load(stream)
+                if trusted:
+                    expense_list = [Expense.trusted(item["id"], item["amount"], item["description"],
+                                                    record_date(item))
+                        for item in expense_list_data]
+                else:
+                    with profile_stage("validate"):
+                        expense_list = [Expense(item["id"], float(item["amount"]), item["description"],
+                                                record_date(item))
+                            for item in expense_list_data]
+            except FileNotFoundError:
+                expense_list = []
+            expense_list.extend(replay_journal(filename, (item.id for item in expense_list)))
+            return expense_list
+
+    def load_table(self) -> "ExpenseTable | BinaryExpenses":
+        """Loads database straight into an ExpenseTable (see read_json_table),
+        for read-only commands.
+        Binary databases without a journal are not loaded at all, rows are read
+        from the memory-mapped file while iterating. With --cache json rows come
+        from the parse cache next to the database (see read_cached_json_table)."""
+        with profile_stage("load"):
+            filename = self.filename
+            if is_binary_db(filename):
+                expenses = BinaryExpenses.open_or_empty(filename)
+                journal_records = replay_journal(filename, (item.id for item in expenses))
+                if not journal_records:
+                    return expenses
+                table = ExpenseTable(expenses)
+                for item in journal_records:
+                    table.append(item)
+                return table
+            read_table = read_cached_json_table if _parse_cache_enabled else read_json_table
+            table = read_table(filename, read_db_meta(filename) is not None)
+            for item in replay_journal(filename, table.ids):
+                table.append(item)
+            return table
+
+    def save(self, expense_list: list[Expense], overwrite: bool = True,
+             stats: ExpenseStats | None = None) -> None:
+        filename = self.filename
+        with self.lock(), profile_stage("save"):
+            if not overwrite and os.path.exists(filename):
+                raise FileExistsError(filename)
+            replace_db_file(filename, batched(expense_list, IMPORT_BATCH_SIZE), is_binary_db(filename))
+            if stats is None:
+                stats = ExpenseStats.from_expenses(expense_list)
+            write_db_meta(filename, stats)
+            # The snapshot now holds everything, journal would only replay duplicates.
+            remove_journal(filename)
+            remove_parse_cache(filename)
+
+    def stats(self) -> ExpenseStats | None:
+        """Aggregates of the whole database without reading its rows, None when
+        they are unknown. Journal records are added on top, there are only a few
+        of them between compactions."""
+        filename = self.filename
+        meta = read_db_meta(filename)
+        if meta is None or "stats" not in meta:
+            return None
+        stats = ExpenseStats(**meta["stats"])
+        for item in replay_journal(filename):
+            stats.add(item)
+        return stats
+
+    def import_batches(self, make_batches: Callable[[IdAllocator, ExpenseStats], Iterable[list[Expense]]]
+                       ) -> None:
+        # New rows are written out batch by batch next to the database, which is
+        # replaced only when all batches have been produced correctly.
+        filename = self.filename
+        with self.lock(), search_index_writer(filename) as index_rows:
+            stats = self.stats()
+            expense_list = self.load()
+            if stats is None:
+                stats = ExpenseStats.from_expenses(expense_list)
+            allocator = IdAllocator(expense_list)
+            # Stages of make_batches run while the file is written and are
+            # subtracted from save
+            with profile_stage("save"):
+                replace_db_file(filename, itertools.chain(
+                    batched(expense_list, IMPORT_BATCH_SIZE),
+                    passing_through(make_batches(allocator, stats), index_rows)),
+                    is_binary_db(filename))
+                write_db_meta(filename, stats)
+                remove_journal(filename)
+                remove_parse_cache(filename)
+
+    def append(self, expenses: list[Expense]) -> None:
+        # Journal keeps the cost proportional to the new rows
+        with self.lock():
+            _, journal_length = open_journal(self.filename)
+            append_to_journal(expenses, self.filename)
+            if journal_length + len(expenses) >= JOURNAL_COMPACT_THRESHOLD:
+                compact_db(self.filename)
+
+
+class SqliteStorage(ExpenseStorage):
+    """SQLite database (.sqlite, .sqlite3, .db). Rows keep insertion order by rowid,
+    ids have their own unique index, the connection runs in WAL mode so readers
+    do not block the writer. Constraints repeat Expense validation, so rows
+    read back are trusted."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS expenses (
+            id INTEGER NOT NULL UNIQUE,
+            amount REAL NOT NULL CHECK (amount >= 0 AND amount <= 10000000000000),
+            description TEXT NOT NULL CHECK (description <> ''),
+            date TEXT
+        )"""
+
+    @contextlib.contextmanager
+    def connect(self) -> Iterator["sqlite3.Connection"]:
+        import sqlite3
+        connection = sqlite3.connect(self.filename, isolation_level=None)
+        try:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(self.SCHEMA)
+            # Databases created before dates get the column, their rows stay undated
+            if "date" not in {column[1] for column in connection.execute("PRAGMA table_info(expenses)")}:
+                connection.execute("ALTER TABLE expenses ADD COLUMN date TEXT")
+            yield connection
+        finally:
+            connection.close()
+
+    @contextlib.contextmanager
+    def transaction(self) -> Iterator["sqlite3.Connection"]:
+        with self.connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+    def rows(self, condition: str = "1", parameters: Sequence = ()) -> Iterator[tuple[int, float, str, int]]:
+        """(id, amount, description, date ordinal) of rows matching condition"""
+        if not os.path.exists(self.filename):
+            return
+        with self.connect() as connection:
+            for id, amount, description, date in connection.execute(
+                    f"SELECT id, amount, description, date FROM expenses WHERE {condition} ORDER BY rowid",
+                    parameters):
+                yield id, amount, description, 0 if date is None else parse_date(date).toordinal()
+
+    def load(self) -> list[Expense]:
+        with profile_stage("load"):
+            return [Expense.trusted(id, amount, description, ordinal_date(ordinal))
+                    for id, amount, description, ordinal in self.rows()]
+
+    def load_table(self) -> ExpenseTable:
+        table = ExpenseTable()
+        with profile_stage("load"):
+            for id, amount, description, ordinal in self.rows():
+                table.add_row(id, amount, description, ordinal)
+        return table
+
+    def load_range(self, start: datetime.date | None = None,
+                   end: datetime.date | None = None) -> ExpenseTable:
+        # ISO dates sort as text
+        table = ExpenseTable()
+        with profile_stage("load"):
+            for id, amount, description, ordinal in self.rows(
+                    "date BETWEEN ? AND ?", [(start or datetime.date.min).isoformat(),
+                                             (end or datetime.date.max).isoformat()]):
+                table.add_row(id, amount, description, ordinal)
+        return table
+
+    def save(self, expense_list: list[Expense], overwrite: bool = True,
+             stats: ExpenseStats | None = None) -> None:
+        if not overwrite and os.path.exists(self.filename):
+            raise FileExistsError(self.filename)
+        with profile_stage("save"), self.transaction() as connection:
+            connection.execute("DELETE FROM expenses")
+            self.insert(connection, expense_list)
+
+    @staticmethod
+    def insert(connection: "sqlite3.Connection", expenses: Iterable[Expense]) -> None:
+        connection.executemany(
+            "INSERT INTO expenses (id, amount, description, date) VALUES (?, ?, ?, ?)",
+            ((item.id, float(item.amount), item.description, item.date and item.date.isoformat())
+             for item in expenses))
+
+    def stats(self) -> ExpenseStats:
+        if not os.path.exists(self.filename):
+            return ExpenseStats()
+        with self.connect() as connection:
+            # Summed as integer cents like ExpenseStats.add does
+            count, cents, big_count = connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(CAST(ROUND(amount * 100) AS INTEGER)), 0),"
+                " COUNT(*) FILTER (WHERE ROUND(amount * 100) >= ?) FROM expenses", [BIG_EXPENSE_CENTS]
+            ).fetchone()
+            huge = connection.execute("SELECT amount FROM expenses WHERE amount >= 10000000")
+            extra_space = max((len(str(amount)) - 8 for amount, in huge), default=0)
+        return ExpenseStats(count=count, cents=cents, big_count=big_count, extra_space=extra_space)
+
+    def next_id(self, connection: "sqlite3.Connection") -> int:
+        """Same id as find_next_id: 1 or the first id whose successor is free"""
+        return connection.execute("""
+            SELECT CASE WHEN NOT EXISTS (SELECT 1 FROM expenses WHERE id = 1) THEN 1
+                   ELSE (SELECT MIN(id) + 1 FROM expenses AS taken
+                         WHERE NOT EXISTS (SELECT 1 FROM expenses WHERE id = taken.id + 1))
+                   END""").fetchone()[0]
+
+    def add(self, amount: float, description: str, date: datetime.date | None = None) -> Expense:
+        with search_index_writer(self.filename) as index_rows:
+            with profile_stage("save"), self.transaction() as connection:
+                with profile_stage("assign ids"):
+                    expense_item = Expense(id=self.next_id(connection), amount=amount, description=description,
+                                           date=date)
+                self.insert(connection, [expense_item])
+            index_rows([expense_item])
+        return expense_item
+
+    def import_batches(self, make_batches: Callable[[IdAllocator, ExpenseStats], Iterable[list[Expense]]]
+                       ) -> None:
+        stats = self.stats()
+        with search_index_writer(self.filename) as index_rows:
+            with profile_stage("save"), self.transaction() as connection:
+                ids = (id for id, in connection.execute("SELECT id FROM expenses"))
+                allocator = IdAllocator.from_ids(ids)
+                for batch in passing_through(make_batches(allocator, stats), index_rows):
+                    self.insert(connection, batch)
+
+
+def is_partitioned_db(filename=DB_FILENAME) -> bool:
+    return filename.endswith(("/", os.sep)) or os.path.isdir(filename)
+
+
+def month_partition(date: datetime.date | None) -> str:
+    """Name of the partition holding expenses of the date, YYYY-MM or undated"""
+    return UNDATED_PARTITION if date is None else f"{date.year:04d}-{date.month:02d}"
+
+
+def month_bounds(partition: str) -> tuple[datetime.date, datetime.date]:
+    """First and last day of a YYYY-MM partition"""
+    first = datetime.date(int(partition[:4]), int(partition[5:]), 1)
+    return first, (first + datetime.timedelta(days=31)).replace(day=1) - datetime.timedelta(days=1)
+
+
+class PartitionedStorage(ExpenseStorage):
+    """Directory database (filename ending with / or an existing directory).
+    Expenses are kept in a json file per month of their date (YYYY-MM.json,
+    undated.json for expenses without one). manifest.json lists the partitions
+    with their aggregates and the size and modification time of their files,
+    which are trusted while they match (as in read_db_meta), and holds the
+    allocator state, so adding rows rewrites only the partitions they go to
+    and reading a date range opens only the months it covers."""
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.filename, MANIFEST_FILENAME)
+
+    def partition_path(self, partition: str) -> str:
+        return os.path.join(self.filename, partition + ".json")
+
+    def lock(self) -> contextlib.AbstractContextManager:
+        os.makedirs(self.filename, exist_ok=True)
+        return lock_db(self.filename)
+
+    def read_manifest(self) -> dict:
+        try:
+            with open(self.manifest_path, encoding="utf-8") as stream:
+                manifest = json.loads(stream.read())
+        except FileNotFoundError:
+            return {"format_version": DB_FORMAT_VERSION, "partitions": {}}
+        if not isinstance(manifest, dict) or manifest.get("format_version") not in (1, DB_FORMAT_VERSION):
+            raise ValueError("Niepoprawny plik bazy danych")
+        if manifest["format_version"] != DB_FORMAT_VERSION:
+            # Partitions stay, their aggregates are recomputed until they are rewritten
+            for entry in manifest["partitions"].values():
+                entry["size"] = None
+            manifest["format_version"] = DB_FORMAT_VERSION
+        return manifest
+
+    def write_manifest(self, manifest: dict) -> None:
+        temp_file = self.manifest_path + ".tmp"
+        with open(temp_file, "w", encoding="utf-8") as stream:
+            stream.write(json.dumps(manifest, indent=2))
+            stream.flush()
+            os.fsync(stream.fileno())
+        os.replace(temp_file, self.manifest_path)
+
+    @staticmethod
+    def ordered(partitions: Iterable[str]) -> list[str]:
+        """Undated partition first (databases migrated from before dates), then months"""
+        return sorted(partitions, key=lambda partition: (partition != UNDATED_PARTITION, partition))
+
+    def is_trusted(self, partition: str, manifest: dict) -> bool:
+        entry = manifest["partitions"][partition]
+        try:
+            stat = os.stat(self.partition_path(partition))
+        except FileNotFoundError:
+            return False
+        return entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns
 
-def add_expense(expense_list: list[Expense], amount: float, description: str) -> None:
-    expense_item = Expense(
-        id=find_next_id(expense_list), amount=amount, description=description
-    )
+    def load_partition(self, partition: str, manifest: dict, table: ExpenseTable | None = None) -> ExpenseTable:
+        return read_json_table(self.partition_path(partition), self.is_trusted(partition, manifest), table)
+
+    def partition_stats(self, partition: str, manifest: dict) -> ExpenseStats:
+        if self.is_trusted(partition, manifest):
+            return ExpenseStats(**manifest["partitions"][partition]["stats"])
+        return ExpenseStats.from_expenses(self.load_partition(partition, manifest))
+
+    def write_partition(self, partition: str, expenses: Iterable[Expense], stats: ExpenseStats) -> dict:
+        """Replaces the partition file, returns its manifest entry"""
+        path = self.partition_path(partition)
+        replace_db_file(path, batched(expenses, IMPORT_BATCH_SIZE))
+        stat = os.stat(path)
+        return {"stats": dataclasses.asdict(stats), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    def months(self, manifest: dict, start: datetime.date | None, end: datetime.date | None) -> list[str]:
+        """Month partitions with days from start to end"""
+        return [partition for partition in self.ordered(manifest["partitions"])
+                if partition != UNDATED_PARTITION
+                and (start is None or partition >= month_partition(start))
+                and (end is None or partition <= month_partition(end))]
+
+    def load(self) -> list[Expense]:
+        return list(self.load_table())
+
+    def load_table(self) -> ExpenseTable:
+        with profile_stage("load"):
+            manifest = self.read_manifest()
+            table = ExpenseTable()
+            for partition in self.ordered(manifest["partitions"]):
+                self.load_partition(partition, manifest, table)
+            return table
+
+    def load_range(self, start: datetime.date | None = None,
+                   end: datetime.date | None = None) -> ExpenseTable:
+        with profile_stage("load"):
+            manifest = self.read_manifest()
+            table = ExpenseTable()
+            for partition in self.months(manifest, start, end):
+                self.load_partition(partition, manifest, table)
+        return table.between(start, end)
+
+    def stats(self) -> ExpenseStats:
+        manifest = self.read_manifest()
+        stats = ExpenseStats()
+        for partition in manifest["partitions"]:
+            stats.merge(self.partition_stats(partition, manifest))
+        return stats
+
+    def range_stats(self, start: datetime.date | None = None,
+                    end: datetime.date | None = None) -> ExpenseStats:
+        # Months wholly inside the range come from the manifest, only the
+        # months at its ends are read
+        manifest = self.read_manifest()
+        stats = ExpenseStats()
+        for partition in self.months(manifest, start, end):
+            first, last = month_bounds(partition)
+            if (start is None or start <= first) and (end is None or last <= end):
+                stats.merge(self.partition_stats(partition, manifest))
+            else:
+                with profile_stage("load"):
+                    stats.merge(ExpenseStats.from_expenses(
+                        self.load_partition(partition, manifest).between(start, end)))
+        return stats
+
+    def save(self, expense_list: list[Expense], overwrite: bool = True,
+             stats: ExpenseStats | None = None) -> None:
+        with self.lock(), profile_stage("save"):
+            if not overwrite and os.path.exists(self.manifest_path):
+                raise FileExistsError(self.filename)
+            old_manifest = self.read_manifest()
+            partitions: dict[str, list[Expense]] = {}
+            for item in expense_list:
+                partitions.setdefault(month_partition(item.date), []).append(item)
+            manifest = {"format_version": DB_FORMAT_VERSION, "allocator": IdAllocator(expense_list).to_state(),
+                        "partitions": {partition: self.write_partition(partition, expenses,
+                                                                       ExpenseStats.from_expenses(expenses))
+                                       for partition, expenses in partitions.items()}}
+            self.write_manifest(manifest)
+            for partition in old_manifest["partitions"].keys() - partitions.keys():
+                os.remove(self.partition_path(partition))
+
+    def add(self, amount: float, description: str, date: datetime.date | None = None) -> Expense:
+        return self.add_many([(amount, description, date)])[0]
+
+    @staticmethod
+    def read_spilled_rows(path: str) -> Iterator[Expense]:
+        """Expenses spilled to a temporary file by import_batches"""
+        import marshal
+        with open(path, "rb") as stream:
+            while True:
+                try:
+                    rows = marshal.load(stream)
+                except EOFError:
+                    return
+                for id, amount, description, ordinal in rows:
+                    yield Expense.trusted(id, amount, description, ordinal_date(ordinal))
+
+    def import_batches(self, make_batches: Callable[[IdAllocator, ExpenseStats], Iterable[list[Expense]]]
+                       ) -> None:
+        # Each batch is sorted into partitions and spilled to a temporary file
+        # per partition (marshal, dates as ordinals, as in parse_csv_file), so
+        # only one batch is held while batches are produced. Afterwards only
+        # partitions getting new rows are rewritten, one at a time. The manifest
+        # is replaced last, a partition written before an interruption no
+        # longer matches its entry and is validated again when read.
+        import marshal
+        import tempfile
+        with self.lock(), search_index_writer(self.filename) as index_rows, \
+                tempfile.TemporaryDirectory(prefix="import-partitions-") as spill_dir:
+            manifest = self.read_manifest()
+            allocator = (IdAllocator.from_state(manifest["allocator"]) if "allocator" in manifest
+                         else IdAllocator())
+            added: dict[str, ExpenseStats] = {}
+            for batch in passing_through(make_batches(allocator, self.stats()), index_rows):
+                spilled: dict[str, list[tuple]] = {}
+                for item in batch:
+                    partition = month_partition(item.date)
+                    added.setdefault(partition, ExpenseStats()).add(item)
+                    spilled.setdefault(partition, []).append(
+                        (item.id, item.amount, item.description, date_ordinal(item.date)))
+                for partition, rows in spilled.items():
+                    with open(os.path.join(spill_dir, partition + ".rows"), "ab") as stream:
+                        marshal.dump(rows, stream)
+            with profile_stage("save"):
+                for partition, stats in added.items():
+                    if partition in manifest["partitions"]:
+                        stats.merge(self.partition_stats(partition, manifest))
+                        rows = self.load_partition(partition, manifest)
+                    else:
+                        rows = ExpenseTable()
+                    manifest["partitions"][partition] = self.write_partition(
+                        partition, itertools.chain(
+                            rows, self.read_spilled_rows(os.path.join(spill_dir, partition + ".rows"))),
+                        stats)
+                manifest["allocator"] = allocator.to_state()
+                self.write_manifest(manifest)
+
+    def append(self, expenses: list[Expense]) -> None:
+        # Ids were assigned elsewhere (by serve), the allocator in the manifest
+        # has to learn them
+        def make_batches(allocator: IdAllocator, stats: ExpenseStats) -> Iterator[list[Expense]]:
+            for item in expenses:
+                allocator.claim(item.id)
+                stats.add(item)
+            yield expenses
+
+        self.import_batches(make_batches)
+
+
+class ResidentStorage(ExpenseStorage):
+    """Database kept in memory by `serve`. Rows live in an ExpenseTable,
+    added ones wait in `pending` until serve hands them to the storage the
+    database was loaded from, in the background (see persist_pending).
+    Fingerprints of imported rows (DuplicateFilter) wait with them in
+    `pending_fingerprints` and reach <filename>.dedup only after the rows."""
+
+    def __init__(self, filename: str = DB_FILENAME):
+        super().__init__(filename)
+        self.backing = open_storage(filename)
+        table = self.backing.load_table()
+        self.table = table if isinstance(table, ExpenseTable) else ExpenseTable(table)
+        self.allocator = IdAllocator.from_ids(self.table.ids)
+        self.statistics = self.backing.stats() or ExpenseStats.from_expenses(self.table)
+        self.pending: list[Expense] = []
+        self.pending_fingerprints: set[int] = set()
+
+    def load(self) -> list[Expense]:
+        return list(self.table)
+
+    def load_table(self) -> ExpenseTable:
+        return self.table
+
+    def stats(self) -> ExpenseStats:
+        return dataclasses.replace(self.statistics)
+
+    def add(self, amount: float, description: str, date: datetime.date | None = None) -> Expense:
+        return self.add_many([(amount, description, date)])[0]
+
+    def import_batches(self, make_batches: Callable[[IdAllocator, ExpenseStats], Iterable[list[Expense]]]
+                       ) -> None:
+        # Batches are applied only after all of them were produced, on copies
+        # of allocator and stats, so a failing import changes nothing.
+        allocator = IdAllocator.from_state(self.allocator.to_state())
+        stats = self.stats()
+        added = list(itertools.chain.from_iterable(make_batches(allocator, stats)))
+        for item in added:
+            self.table.append(item)
+        self.allocator, self.statistics = allocator, stats
+        self.pending.extend(added)
+
+    def take_pending(self) -> tuple[list[Expense], set[int]]:
+        """Expenses added since the last call, to be stored by the backing
+        storage, and fingerprints of imported ones, to be saved after them"""
+        pending, self.pending = self.pending, []
+        fingerprints, self.pending_fingerprints = self.pending_fingerprints, set()
+        return pending, fingerprints
+
+
+# Databases served from memory by this process (serve), by absolute path. Only
+# commands run by the server thread see them, its worker threads store rows
+# in the files.
+_resident_storages: dict[str, ResidentStorage] = {}
+_serving_thread: int | None = None
+
+
+def open_storage(filename=DB_FILENAME) -> ExpenseStorage:
+    if _resident_storages and threading.get_ident() == _serving_thread:
+        resident = _resident_storages.get(os.path.abspath(filename))
+        if resident is not None:
+            return resident
+    if filename.endswith(SQLITE_SUFFIXES):
+        return SqliteStorage(filename)
+    if is_partitioned_db(filename):
+        return PartitionedStorage(filename)
+    return FileStorage(filename)
+
+
+def read_db_or_init(filename=DB_FILENAME) -> list[Expense]:
+    "Loads data from a database and returns empty list if database is not found."
+    return open_storage(filename).load()
+
+
+def read_db_table(filename=DB_FILENAME) -> Sequence[Expense]:
+    """Loads database for read-only commands, see ExpenseStorage.load_table"""
+    return open_storage(filename).load_table()
+
+
+def read_db_stats(filename=DB_FILENAME) -> ExpenseStats | None:
+    return open_storage(filename).stats()
+
+
+def save_db(expense_list: list[Expense], filename=DB_FILENAME, overwrite: bool = True,
+            stats: ExpenseStats | None = None) -> None:
+    open_storage(filename).save(expense_list, overwrite, stats)
+
+
+def search_tokens(text: str) -> list[str]:
+    return SEARCH_TOKEN.findall(text.lower())
+
+
+def db_stamp(filename=DB_FILENAME) -> str:
+    """Size and modification time of every file holding rows of the database.
+    Any write changes it, so an index with the same stamp is up to date."""
+    stamp = []
+    # Sidecars may be inside a partitioned database, its directory changes with them
+    main_file = os.path.join(filename, MANIFEST_FILENAME) if is_partitioned_db(filename) else filename
+    for path in (main_file, journal_path(filename), filename + "-wal"):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            stamp.append(None)
+        else:
+            stamp.append([stat.st_size, stat.st_mtime_ns])
+    return json.dumps(stamp)
+
+
+class SearchIndex:
+    """Inverted index of descriptions in <filename>.search, a SQLite file with
+    (token, id) postings and a copy of indexed rows, so queries read only the
+    matching ones. It is built by the first search and from then on updated by
+    every write adding rows (search_index_writer). The stamp of the database
+    it matches is stored with it, an index not matching is rebuilt, as is one
+    with an older VERSION of the schema."""
+
+    VERSION = 2
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS docs (
+            id INTEGER PRIMARY KEY,
+            amount REAL NOT NULL,
+            description TEXT NOT NULL,
+            date TEXT
+        );
+        CREATE TABLE IF NOT EXISTS postings (token TEXT NOT NULL, id INTEGER NOT NULL);
+        CREATE TABLE IF NOT EXISTS stamp (value TEXT NOT NULL);
+        """
+    # Created after the initial bulk insert, which is much faster without them
+    INDEXES = """
+        CREATE INDEX IF NOT EXISTS postings_token ON postings (token, id);
+        CREATE INDEX IF NOT EXISTS docs_amount ON docs (amount);
+        """
+
+    def __init__(self, filename: str = DB_FILENAME):
+        self.filename = filename
+        self.path = filename + SEARCH_SUFFIX
+
+    @contextlib.contextmanager
+    def transaction(self) -> Iterator["sqlite3.Connection"]:
+        import sqlite3
+        connection = sqlite3.connect(self.path, isolation_level=None)
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+        finally:
+            connection.close()
+
+    def is_current(self) -> bool:
+        if not os.path.exists(self.path):
+            return False
+        import sqlite3
+        try:
+            connection = sqlite3.connect(self.path)
+            try:
+                version, = connection.execute("PRAGMA user_version").fetchone()
+                row = connection.execute("SELECT value FROM stamp").fetchone()
+            finally:
+                connection.close()
+        except sqlite3.Error:
+            return False
+        return version == self.VERSION and row is not None and row[0] == db_stamp(self.filename)
+
+    @staticmethod
+    def insert(connection: "sqlite3.Connection", expenses: Iterable[Expense]) -> None:
+        expenses = list(expenses)
+        connection.executemany("INSERT OR REPLACE INTO docs (id, amount, description, date) VALUES (?, ?, ?, ?)",
+                               ((item.id, float(item.amount), item.description,
+                                 item.date and item.date.isoformat()) for item in expenses))
+        connection.executemany("INSERT INTO postings (token, id) VALUES (?, ?)",
+                               ((token, item.id) for item in expenses
+                                for token in set(search_tokens(item.description))))
+
+    def write_stamp(self, connection: "sqlite3.Connection") -> None:
+        connection.execute("DELETE FROM stamp")
+        connection.execute("INSERT INTO stamp (value) VALUES (?)", (db_stamp(self.filename),))
+
+    def rebuild(self, expenses: Iterable[Expense]) -> None:
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        with self.transaction() as connection:
+            for statement in self.SCHEMA.split(";"):
+                connection.execute(statement)
+            for batch in batched(expenses, IMPORT_BATCH_SIZE):
+                self.insert(connection, batch)
+            for statement in self.INDEXES.split(";"):
+                connection.execute(statement)
+            connection.execute(f"PRAGMA user_version = {self.VERSION}")
+            self.write_stamp(connection)
+
+    @staticmethod
+    def parse_query(text: str) -> list[tuple[str, bool]]:
+        """Tokens of query text, each with True when it is a prefix (word*)"""
+        terms = []
+        for word in text.split():
+            tokens = search_tokens(word.rstrip("*"))
+            terms += [(token, word.endswith("*") and position == len(tokens))
+                      for position, token in enumerate(tokens, 1)]
+        return terms
+
+    @staticmethod
+    def posting_condition(token: str, prefix: bool) -> tuple[str, list[str]]:
+        if not prefix:
+            return "token = ?", [token]
+        # Every token starting with the prefix sorts below the prefix with
+        # its last character incremented
+        return "token >= ? AND token < ?", [token, token[:-1] + chr(ord(token[-1]) + 1)]
+
+    def query(self, text: str = "", min_amount: float | None = None,
+              max_amount: float | None = None) -> list[Expense]:
+        """Expenses whose description has all words of text, a word ending
+        with * matches any word starting with it. Ordered by id.
+        Only rows matching the condition with the fewest of them are read,
+        other words are checked on the descriptions of those rows."""
+        terms = self.parse_query(text)
+        amount_conditions, amount_parameters = [], []
+        if min_amount is not None:
+            amount_conditions.append("amount >= ?")
+            amount_parameters.append(min_amount)
+        if max_amount is not None:
+            amount_conditions.append("amount <= ?")
+            amount_parameters.append(max_amount)
+        import sqlite3
+        connection = sqlite3.connect(self.path)
+        try:
+            def estimate(table: str, condition: str, parameters: list) -> int:
+                return connection.execute(
+                    f"SELECT COUNT(*) FROM (SELECT 1 FROM {table} WHERE {condition} LIMIT ?)",
+                    [*parameters, SEARCH_ESTIMATE_LIMIT]).fetchone()[0]
+
+            # With a single condition there is nothing to choose from
+            choosing = len(terms) + bool(amount_conditions) > 1
+            estimates = [estimate("postings", *self.posting_condition(*term)) if choosing else 0 for term in terms]
+            if amount_conditions and (not terms or estimate(
+                    "docs", " AND ".join(amount_conditions), amount_parameters) < min(estimates)):
+                source, conditions, parameters = "docs", [], []
+            else:
+                condition, parameters = self.posting_condition(*terms.pop(estimates.index(min(estimates))))
+                source = "postings JOIN docs USING (id)"
+                conditions = [condition]
+            rows = connection.execute(
+                f"SELECT DISTINCT id, amount, description, date FROM {source} "
+                f"WHERE {' AND '.join(conditions + amount_conditions)}", parameters + amount_parameters)
+            found = []
+            for id, amount, description, date in rows:
+                tokens = search_tokens(description)
+                if all(any(word.startswith(token) for word in tokens) if prefix else token in tokens
+                       for token, prefix in terms):
+                    found.append(Expense.trusted(id, amount, description, date and parse_date(date)))
+            found.sort(key=operator.attrgetter("id"))
+            return found
+        finally:
+            connection.close()
+
+
+@contextlib.contextmanager
+def search_index_writer(filename=DB_FILENAME) -> Iterator[Callable[[Iterable[Expense]], None]]:
+    """Wraps a write adding rows to the database. Yields function to be called
+    with the added rows, which go into the search index, committed together
+    with the stamp of the database once the write is done. A missing or
+    outdated index is left alone, the next search rebuilds it."""
+    index = SearchIndex(filename)
+    if not index.is_current():
+        yield lambda expenses: None
+        return
+    with index.transaction() as connection:
+        yield functools.partial(index.insert, connection)
+        index.write_stamp(connection)
+
+
+def search_expenses(filename=DB_FILENAME, text: str = "", min_amount: float | None = None,
+                    max_amount: float | None = None) -> list[Expense]:
+    index = SearchIndex(filename)
+    storage = open_storage(filename)
+    if not index.is_current():
+        with storage.lock():
+            if not index.is_current():
+                click.echo("Budowanie indeksu wyszukiwania...", err=True)
+                index.rebuild(storage.load_table())
+    return index.query(text, min_amount, max_amount)
+
+
+def write_json_records(stream: TextIO, batches: Iterable[list[Expense]]) -> None:
+    """Writes expenses batch by batch with exactly the same layout as
+    json.dump(..., indent=2) of the whole list, without building that list."""
+    first = True
+    for batch in batches:
+        if not batch:
+            continue
+        stream.write("[\n  " if first else ",\n  ")
+        stream.write(",\n  ".join(
+            json.dumps(expense_record(item), indent=2).replace("\n", "\n  ")
+            for item in batch))
+        first = False
+    stream.write("[]" if first else "\n]")
+
+
+def journal_path(filename=DB_FILENAME) -> str:
+    return filename + JOURNAL_SUFFIX
+
+
+def remove_journal(filename=DB_FILENAME) -> None:
+    if os.path.exists(journal_path(filename)):
+        os.remove(journal_path(filename))
+
+
+def read_journal(filename=DB_FILENAME) -> tuple[IdAllocator, list[Expense]]:
+    """Reads journal next to the database. First line holds allocator state of the
+    snapshot, every following line is one appended expense. Returns allocator
+    with journaled ids already claimed and the journaled expenses."""
+    with open(journal_path(filename), encoding="utf-8") as stream:
+        allocator = IdAllocator.from_state(json.loads(stream.readline()))
+        records = []
+        for line in stream:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            records.append(Expense(item["id"], float(item["amount"]), item["description"], record_date(item)))
+            allocator.claim(item["id"])
+    return allocator, records
+
+
+def open_journal(filename=DB_FILENAME) -> tuple[IdAllocator, int]:
+    """Returns allocator for new journal records and number of records already
+    in the journal. Snapshot is parsed only when the journal has to be started."""
+    if os.path.exists(journal_path(filename)):
+        allocator, records = read_journal(filename)
+        return allocator, len(records)
+    allocator = IdAllocator(read_db_or_init(filename))
+    with search_index_writer(filename), open(journal_path(filename), "w", encoding="utf-8") as stream:
+        stream.write(json.dumps(allocator.to_state()) + "\n")
+    return allocator, 0
+
+
+def append_to_journal(expenses: list[Expense], filename=DB_FILENAME) -> None:
+    with search_index_writer(filename) as index_rows:
+        with profile_stage("save"), open(journal_path(filename), "a", encoding="utf-8") as stream:
+            stream.writelines(json.dumps(expense_record(item)) + "\n" for item in expenses)
+        index_rows(expenses)
+
+
+def compact_db(filename=DB_FILENAME) -> None:
+    """Folds the journal into the snapshot. save_db removes the journal afterwards."""
+    # Rows stay the same, an up-to-date search index only gets the new stamp
+    with lock_db(filename), search_index_writer(filename):
+        save_db(read_db_or_init(filename), filename)
+
+
+def add_expense(expense_list: list[Expense], amount: float, description: str,
+                allocator: IdAllocator | None = None, stats: ExpenseStats | None = None,
+                date: datetime.date | None = None) -> None:
+    next_id = allocator.next_id() if allocator is not None else find_next_id(expense_list)
+    expense_item = Expense(id=next_id, amount=amount, description=description, date=date)
     expense_list.append(expense_item)
+    if stats is not None:
+        stats.add(expense_item)
+
+
+def add_to_journal(amount: float, description: str, filename=DB_FILENAME) -> None:
+    """Adds a single expense without rewriting the database.
+    Cost depends on journal length only, which compaction keeps bounded."""
+    add_many_to_journal([(amount, description, None)], filename)
+
+
+def add_many_to_journal(rows: list[tuple[float, str, datetime.date | None]], filename=DB_FILENAME) -> None:
+    with lock_db(filename):
+        allocator, journal_length = open_journal(filename)
+        expense_list = []
+        try:
+            with profile_stage("assign ids"):
+                for amount, description, date in rows:
+                    add_expense(expense_list, amount, description, allocator, date=date)
+        except ValueError as e:
+            print(f"Błąd - {e.args[0]}")
+            sys.exit(1)
+        append_to_journal(expense_list, filename)
+        if journal_length + len(expense_list) >= JOURNAL_COMPACT_THRESHOLD:
+            compact_db(filename)
+
+
+def queue_path(filename=DB_FILENAME) -> str:
+    return filename + QUEUE_SUFFIX
+
+
+def add_with_group_commit(rows: list[tuple[float, str, datetime.date | None]], filename=DB_FILENAME,
+                          journal: bool = False) -> None:
+    """Adds rows together with rows of other writers waiting for the database lock.
+    Rows are queued in <filename>.queue first, whoever gets the lock next saves
+    everything queued in a single rewrite (or journal append). Writers whose rows
+    are gone from the queue once they get the lock have nothing left to do.
+    Entries leave the queue only after they were saved, so rows of a writer
+    killed while saving are picked up by the next one. Rows are checked before
+    they are queued; an incorrect entry already in the queue (e.g. of an older
+    version) is left out of the group and moved to <filename>.queue.rejects
+    with its error, its writer finds it there and gets the ValueError."""
+    for amount, description, _ in rows:
+        check_expense(amount, description)
+    if is_partitioned_db(filename):
+        # The queue and the lock are inside a directory database
+        os.makedirs(filename, exist_ok=True)
+    token = os.urandom(8).hex()
+    with locked_file(queue_path(filename)) as stream:
+        queued_rows = [(amount, description, date and date.isoformat()) for amount, description, date in rows]
+        stream.write(json.dumps({"token": token, "rows": queued_rows}).encode("utf-8") + b"\n")
+    with lock_db(filename):
+        with locked_file(queue_path(filename)) as stream:
+            stream.seek(0)
+            queued = stream.read()
+        entries = [json.loads(line) for line in queued.splitlines()]
+        if not any(entry["token"] == token for entry in entries):
+            take_rejected_entry(filename, token)
+            return
+        group, rejected = [], []
+        for entry in entries:
+            try:
+                entry_rows = [(amount, description, date and parse_date(date))
+                              for amount, description, date in entry["rows"]]
+                for amount, description, _ in entry_rows:
+                    check_expense(amount, description)
+            except ValueError as error:
+                if entry["token"] == token:
+                    remove_queued_entries(filename, queued, {token})
+                    raise
+                rejected.append({**entry, "error": error.args[0]})
+            else:
+                group.extend(entry_rows)
+        if rejected:
+            with open(queue_path(filename) + REJECTS_SUFFIX, "a", encoding="utf-8") as stream:
+                stream.writelines(json.dumps(entry) + "\n" for entry in rejected)
+        rejected_tokens = {entry["token"] for entry in rejected}
+        try:
+            if journal:
+                add_many_to_journal(group, filename)
+            else:
+                open_storage(filename).add_many(group)
+        except ValueError:
+            # The other entries stay queued for the next writer
+            remove_queued_entries(filename, queued, {token} | rejected_tokens)
+            raise
+        remove_queued_entries(filename, queued, {entry["token"] for entry in entries})
+
+
+def take_rejected_entry(filename: str, token: str) -> None:
+    """Raises the ValueError of a queued entry another writer rejected, removing
+    it from <filename>.queue.rejects. Called under the database lock."""
+    path = queue_path(filename) + REJECTS_SUFFIX
+    try:
+        with open(path, encoding="utf-8") as stream:
+            rejects = [json.loads(line) for line in stream]
+    except FileNotFoundError:
+        return
+    own = [entry for entry in rejects if entry["token"] == token]
+    if not own:
+        return
+    rest = [entry for entry in rejects if entry["token"] != token]
+    if rest:
+        with open(path, "w", encoding="utf-8") as stream:
+            stream.writelines(json.dumps(entry) + "\n" for entry in rest)
+    else:
+        os.remove(path)
+    raise ValueError(own[0]["error"])
+
+
+def remove_queued_entries(filename: str, queued: bytes, tokens: set[str]) -> None:
+    """Removes entries with the given tokens from the group commit queue.
+    queued is the queue as read before, only appends can have happened since."""
+    with locked_file(queue_path(filename)) as stream:
+        stream.seek(0)
+        rest = stream.read()[len(queued):]
+        kept = [line for line in queued.splitlines(keepends=True) if json.loads(line)["token"] not in tokens]
+        stream.truncate(0)
+        stream.write(b"".join(kept) + rest)
 
 
 def create_Expense_item_from_dict(row: dict[str, str]):
@@ -108,33 +2086,366 @@ def create_Expense_item_from_dict(row: dict[str, str]):
         sys.exit(1)
 
 
-def read_expenses(csv_file_path: str, expense_list: list[Expense]) -> list[Expense]:
+def require_csv_columns(fieldnames: list[str] | None) -> None:
+    if fieldnames is not None and not {"amount", "description"} <= set(fieldnames):
+        print("Błąd pliku - akceptowalne pliki z kluczami 'amount' oraz 'description'")
+        sys.exit(1)
+
+
+def iter_csv_batches(csv_file_path: str, batch_size: int = IMPORT_BATCH_SIZE
+                     ) -> Iterator[list[tuple[float, str, datetime.date | None]]]:
+    """Yields validated (amount, description, date) rows of a csv file in batches.
+    Whole amount column of a batch is checked at once by validate_rows.
+    The date column is optional, without it all rows are undated."""
+    import csv
+    with open(csv_file_path, encoding="utf-8") as stream:
+        reader = csv.DictReader(stream)
+        require_csv_columns(reader.fieldnames)
+        dated = "date" in (reader.fieldnames or ())
+        first_row = 2  # line 1 is the header
+        for rows in batched(reader, batch_size):
+            amounts = list(map(operator.itemgetter("amount"), rows))
+            descriptions = list(map(operator.itemgetter("description"), rows))
+            try:
+                with profile_stage("validate"):
+                    dates, date_error = itertools.repeat(None), None
+                    if dated:
+                        try:
+                            dates = validate_dates(list(map(operator.itemgetter("date"), rows)), first_row)
+                        except CsvRowError as error:
+                            date_error = error
+                    try:
+                        values = validate_rows(amounts, descriptions, first_row)
+                    except CsvRowError as error:
+                        # The first incorrect row wins, as in validate_rows
+                        if date_error is None or error.row <= date_error.row:
+                            raise
+                    if date_error is not None:
+                        raise date_error
+                    validated = list(zip(values, descriptions, dates))
+            except CsvRowError as error:
+                raise CsvRowError(error.args[0], error.row, csv_file_path) from None
+            yield validated
+            first_row += len(rows)
+
+
+def parse_csv_file(csv_file_path: str, spill_dir: str, batch_size: int = IMPORT_BATCH_SIZE) -> str:
+    """Validates a csv file in a worker process of a multi-file import.
+    Batches of rows are written one after another (in the marshal format, dates
+    as ordinals) to a spill file in spill_dir as they are validated, so neither
+    the worker nor the importing process holds the whole file. Returns its path."""
+    import marshal
+    import tempfile
+    descriptor, path = tempfile.mkstemp(suffix=".rows", dir=spill_dir)
+    with os.fdopen(descriptor, "wb") as stream:
+        for rows in iter_csv_batches(csv_file_path, batch_size):
+            marshal.dump([(amount, description, date_ordinal(date)) for amount, description, date in rows], stream)
+    return path
+
+
+def read_spilled_batches(path: str) -> Iterator[list[tuple[float, str, datetime.date | None]]]:
+    """Batches of rows written by parse_csv_file, the file is removed once read"""
+    import marshal
+    with open(path, "rb") as stream:
+        while True:
+            try:
+                rows = marshal.load(stream)
+            except EOFError:
+                break
+            yield [(amount, description, ordinal_date(ordinal)) for amount, description, ordinal in rows]
+    os.remove(path)
+
+
+def iter_csv_files_batches(csv_files: list[str], batch_size: int = IMPORT_BATCH_SIZE,
+                           jobs: int = 1) -> Iterator[tuple[str, list[tuple[float, str, datetime.date | None]]]]:
+    """Yields validated rows of all csv files, always in the order of csv_files,
+    in batches paired with the file they come from. With more than one job files
+    are parsed in a process pool, results are consumed in submission order so
+    ids do not depend on worker scheduling. Workers spill validated batches to
+    temporary files (see parse_csv_file) which are read back batch by batch, and
+    at most two files per job are parsed ahead of the one being imported, so
+    memory stays bounded by the batch size however big the files are."""
+    if jobs <= 1 or len(csv_files) <= 1:
+        for csv_file in csv_files:
+            for rows in iter_csv_batches(csv_file, batch_size):
+                yield csv_file, rows
+        return
+    import csv
+    from concurrent.futures import ProcessPoolExecutor
+    # Missing columns end the import with a message, check them before any work starts.
+    for csv_file in csv_files:
+        with open(csv_file, encoding="utf-8") as stream:
+            require_csv_columns(csv.DictReader(stream).fieldnames)
+    import collections
+    import tempfile
+    with tempfile.TemporaryDirectory(prefix="import-csv-") as spill_dir, \
+            ProcessPoolExecutor(max_workers=jobs) as executor:
+        pending = collections.deque()
+        remaining = iter(csv_files)
+        try:
+            for csv_file in itertools.islice(remaining, 2 * jobs):
+                pending.append((csv_file, executor.submit(parse_csv_file, csv_file, spill_dir, batch_size)))
+            while pending:
+                csv_file, future = pending.popleft()
+                path = future.result()
+                for next_file in itertools.islice(remaining, 1):
+                    pending.append((next_file, executor.submit(parse_csv_file, next_file, spill_dir, batch_size)))
+                for batch in read_spilled_batches(path):
+                    yield csv_file, batch
+        finally:
+            # Files not started yet are not parsed after an error
+            for _, future in pending:
+                future.cancel()
+
+
+def iter_expenses(csv_file_path: str, allocator: IdAllocator,
+                  batch_size: int = IMPORT_BATCH_SIZE) -> Iterator[Expense]:
+    """Yields csv rows as Expense items with ids taken from the allocator"""
+    for batch in iter_csv_batches(csv_file_path, batch_size):
+        for amount, description, date in batch:
+            yield Expense(id=allocator.next_id(), amount=amount, description=description, date=date)
+
+
+def passing_through(batches: Iterable[list], callback: Callable[[list], None]) -> Iterator[list]:
+    """Yields batches unchanged, handing each one to callback first"""
+    for batch in batches:
+        callback(batch)
+        yield batch
+
+
+def batched(items: Iterable, size: int) -> Iterator[list]:
+    """Splits any iterable into lists of at most `size` items"""
+    iterator = iter(items)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+def read_expenses(csv_file_path: str, expense_list: list[Expense],
+                  allocator: IdAllocator | None = None, stats: ExpenseStats | None = None) -> list[Expense]:
     """Reads expenses from a file and returns them as Expense class list of items
     
     """
-    with open(csv_file_path, encoding="utf-8") as stream:
-        reader = csv.DictReader(stream)
+    if allocator is None:
+        allocator = IdAllocator(expense_list)
+    try:
+        start = len(expense_list)
+        expense_list.extend(iter_expenses(csv_file_path, allocator))
+        if stats is not None:
+            for item in itertools.islice(expense_list, start, None):
+                stats.add(item)
+        return expense_list
+    except ValueError as f:
+        print(f"Błąd - {format_error(f)}")
+        sys.exit(1)
+
+
+def iter_import_batches(csv_files: list[str], allocator: IdAllocator, batch_size: int = IMPORT_BATCH_SIZE,
+                        progress: Callable[[int], None] | None = None, jobs: int = 1,
+                        stats: ExpenseStats | None = None,
+                        duplicates: "DuplicateFilter | None" = None) -> Iterator[list[Expense]]:
+    """Yields csv expenses in batches, reporting number of rows imported so far.
+    Ids are assigned here, in a single pass over all files, to rows which
+    passed the duplicate filter if there is one."""
+    imported = 0
+    for csv_file, rows in iter_csv_files_batches(csv_files, batch_size, jobs):
+        if duplicates is not None:
+            rows = duplicates.filter(csv_file, rows)
+        with profile_stage("assign ids"):
+            batch = [Expense(id=allocator.next_id(), amount=amount, description=description, date=date)
+                     for amount, description, date in rows]
+            if stats is not None:
+                for item in batch:
+                    stats.add(item)
+        imported += len(batch)
+        if progress is not None:
+            progress(imported)
+        yield batch
+
+
+def file_digest(path: str) -> str:
+    """blake2b hash of the file contents, read in chunks"""
+    from hashlib import blake2b
+    hash = blake2b(digest_size=16)
+    with open(path, "rb") as stream:
+        while chunk := stream.read(1 << 20):
+            hash.update(chunk)
+    return hash.hexdigest()
+
+
+def row_fingerprint(amount: float, description: str, date: datetime.date | None, occurrence: int,
+                    source: str) -> int:
+    """64-bit hash of a csv row: its values, how many equal rows came before
+    it in the same file and the file it comes from (source, the file_digest of
+    the csv file). Two identical rows of one file (e.g. two coffees on one day)
+    differ, as do equal rows of two different exports (the same subscription
+    every month), the same export imported again does not."""
+    from hashlib import blake2b
+    text = f"{source}\0{amount!r}\0{description}\0{occurrence}"
+    if date is not None:
+        text += f"\0{date.isoformat()}"
+    digest = blake2b(text.encode("utf-8"), digest_size=8)
+    return int.from_bytes(digest.digest(), "little", signed=True)
+
+
+class DuplicateFilter:
+    """Checks csv rows against fingerprints (row_fingerprint) of every row
+    imported before, kept in <filename>.dedup, a SQLite file with a single
+    integer key per row. Fingerprints of a whole batch are looked up in one
+    query and new ones are added in the same transaction, which is committed
+    only when the import succeeds (see duplicate_filter). pending holds
+    fingerprints of rows served from memory and not stored yet, they are known
+    as well; new ones are collected in `added`.
+    on_duplicate: "skip" drops rows imported before, "error" stops the
+    import, "allow" imports them again."""
+
+    SCHEMA = "CREATE TABLE IF NOT EXISTS fingerprints (hash INTEGER PRIMARY KEY)"
+    # Kept below the smallest SQLite limit of query parameters
+    LOOKUP_CHUNK = 900
+
+    def __init__(self, connection: "sqlite3.Connection", on_duplicate: str = "skip",
+                 pending: set[int] | None = None):
+        self.connection = connection
+        self.on_duplicate = on_duplicate
+        self.pending = pending or set()
+        self.added: list[int] = []
+        self.skipped = 0
+        self.csv_file = None
+        self.source = ""
+        self.occurrences: dict[tuple[float, str, datetime.date | None], int] = {}
+        self.next_row = 2  # line 1 is the header
+
+    def find(self, fingerprints: list[int]) -> set[int]:
+        found = self.pending.intersection(fingerprints)
+        for chunk in batched(fingerprints, self.LOOKUP_CHUNK):
+            found.update(hash for hash, in self.connection.execute(
+                f"SELECT hash FROM fingerprints WHERE hash IN ({', '.join('?' * len(chunk))})", chunk))
+        return found
+
+    def filter(self, csv_file: str, rows: list[tuple[float, str, datetime.date | None]]
+               ) -> list[tuple[float, str, datetime.date | None]]:
+        if csv_file != self.csv_file:
+            self.csv_file, self.occurrences, self.next_row = csv_file, {}, 2
+            self.source = file_digest(csv_file)
+        fingerprints = []
+        for row in rows:
+            occurrence = self.occurrences.get(row, 0)
+            self.occurrences[row] = occurrence + 1
+            fingerprints.append(row_fingerprint(*row, occurrence, self.source))
+        known = self.find(fingerprints)
+        kept, new = [], []
+        for line, row, fingerprint in zip(itertools.count(self.next_row), rows, fingerprints):
+            if fingerprint in known:
+                if self.on_duplicate == "error":
+                    raise CsvRowError("Wiersz został już wcześniej zaimportowany", line, csv_file)
+                if self.on_duplicate == "skip":
+                    self.skipped += 1
+                    continue
+            else:
+                new.append((fingerprint,))
+            kept.append(row)
+        # Later rows see these as known, e.g. of a copy of the export given in the same import
+        self.connection.executemany("INSERT OR IGNORE INTO fingerprints (hash) VALUES (?)", new)
+        self.added.extend(fingerprint for fingerprint, in new)
+        self.next_row += len(rows)
+        return kept
+
+
+def dedup_path(filename=DB_FILENAME) -> str:
+    return filename + DEDUP_SUFFIX
+
+
+@contextlib.contextmanager
+def duplicate_filter(filename=DB_FILENAME, on_duplicate: str = "skip") -> Iterator[DuplicateFilter]:
+    """DuplicateFilter of the database, its new fingerprints are saved when
+    the block ends without an exception. Fingerprints are forgotten once
+    the database has no expenses, e.g. after it was deleted. A database served
+    from memory gets them as pending instead, they are saved once its rows
+    are stored (see persist_pending)."""
+    storage = open_storage(filename)
+    resident = storage if isinstance(storage, ResidentStorage) else None
+    if os.path.exists(dedup_path(filename)):
+        # A new --journal database has only the journal until it is compacted
+        count = 0
+        if os.path.exists(filename) or os.path.exists(journal_path(filename)):
+            stats = read_db_stats(filename)
+            count = stats.count if stats is not None else len(read_db_table(filename))
+        if not count:
+            os.remove(dedup_path(filename))
+    import sqlite3
+    connection = sqlite3.connect(dedup_path(filename), isolation_level=None)
+    try:
+        connection.execute(DuplicateFilter.SCHEMA)
+        connection.execute("BEGIN IMMEDIATE")
         try:
-            expenses_no_id = [create_Expense_item_from_dict(row) for row in reader]
-            for expense in expenses_no_id:
-                expense_csv = Expense(
-                        id=find_next_id(expense_list),
-                        amount=float(expense.amount),
-                        description=expense.description,
-                    )
-                expense_list.append(expense_csv)
-            return expense_list
-        except ValueError as f:
-            print(f"Błąd - {f.args[0]}")
-            sys.exit(1)
+            duplicates = DuplicateFilter(connection, on_duplicate,
+                                         resident.pending_fingerprints if resident is not None else None)
+            yield duplicates
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        if resident is None:
+            connection.execute("COMMIT")
+        else:
+            connection.execute("ROLLBACK")
+            resident.pending_fingerprints.update(duplicates.added)
+    finally:
+        connection.close()
 
 
-def add_csv_to_db(csv_file, db_file=DB_FILENAME):
+def save_fingerprints(filename: str, fingerprints: Iterable[int]) -> None:
+    """Adds fingerprints of rows stored by serve to <filename>.dedup"""
+    import sqlite3
+    connection = sqlite3.connect(dedup_path(filename))
+    try:
+        with connection:
+            connection.execute(DuplicateFilter.SCHEMA)
+            connection.executemany("INSERT OR IGNORE INTO fingerprints (hash) VALUES (?)",
+                                   ((fingerprint,) for fingerprint in fingerprints))
+    finally:
+        connection.close()
+
+
+def add_csv_to_db(csv_file: str | list[str], db_file=DB_FILENAME, batch_size: int = IMPORT_BATCH_SIZE,
+                  progress: Callable[[int], None] | None = None, jobs: int = 1,
+                  on_duplicate: str = "skip") -> int:
+    """Imports csv files, returns number of skipped duplicate rows"""
     # Tested manually, csv content successfully added to db.
     # Exceptions correctly raised for incorrect data format or missing columns with appropriate messages.
-    expense_list = read_db_or_init(db_file)
-    expenses_list_updated = read_expenses(csv_file, expense_list)
-    save_db(expenses_list_updated, db_file)
+    csv_files = [csv_file] if isinstance(csv_file, str) else csv_file
+    storage = open_storage(db_file)
+    try:
+        with storage.lock(), duplicate_filter(db_file, on_duplicate) as duplicates:
+            storage.import_batches(lambda allocator, stats: iter_import_batches(
+                csv_files, allocator, batch_size, progress, jobs, stats, duplicates))
+    except ValueError as f:
+        print(f"Błąd - {format_error(f)}")
+        sys.exit(1)
+    return duplicates.skipped
+
+
+def add_csv_to_journal(csv_file: str | list[str], db_file=DB_FILENAME, batch_size: int = IMPORT_BATCH_SIZE,
+                       progress: Callable[[int], None] | None = None, jobs: int = 1,
+                       on_duplicate: str = "skip") -> int:
+    csv_files = [csv_file] if isinstance(csv_file, str) else csv_file
+    with lock_db(db_file), duplicate_filter(db_file, on_duplicate) as duplicates:
+        allocator, journal_length = open_journal(db_file)
+        journal_size = os.path.getsize(journal_path(db_file))
+        try:
+            for batch in iter_import_batches(csv_files, allocator, batch_size, progress, jobs,
+                                             duplicates=duplicates):
+                append_to_journal(batch, db_file)
+                journal_length += len(batch)
+        except ValueError as f:
+            # Drop batches of the broken file that were already appended
+            os.truncate(journal_path(db_file), journal_size)
+            print(f"Błąd - {format_error(f)}")
+            sys.exit(1)
+        except BaseException:
+            os.truncate(journal_path(db_file), journal_size)
+            raise
+        if journal_length >= JOURNAL_COMPACT_THRESHOLD:
+            compact_db(db_file)
+    return duplicates.skipped
 
 
 def strip_zeros(number: float) -> str:
@@ -142,72 +2453,638 @@ def strip_zeros(number: float) -> str:
     return str(number).rstrip("0").rstrip(".") if "." in str(number) else str(number)
 
 
-def print_expenses(expense_list: list[Expense]) -> None:
+def sort_column(expenses: Sequence[Expense], sort: str) -> Sequence:
+    """Values of the `sort` field (id or amount) by row position"""
+    if isinstance(expenses, (ExpenseTable, BinaryExpenses)):
+        return expenses.ids if sort == "id" else expenses.cents
+    return [getattr(item, sort) for item in expenses]
+
+
+def select_expenses(expenses: Sequence[Expense], sort: str | None = None, offset: int = 0,
+                    limit: int | None = None, descending: bool = False) -> Iterable[Expense]:
+    """Rows of one report page. Sorting goes through an index of row positions
+    ordered by the column values; with a limit only offset + limit positions are
+    selected with a heap, so the database is never fully sorted. Unsorted pages
+    of tables are read by position, without building the rows before offset."""
+    if sort is None:
+        if isinstance(expenses, (ExpenseTable, BinaryExpenses)):
+            end = len(expenses) if limit is None else min(len(expenses), offset + limit)
+            return map(expenses.__getitem__, range(offset, end))
+        return itertools.islice(expenses, offset, None if limit is None else offset + limit)
+    keys = sort_column(expenses, sort)
+    positions = range(len(keys))
+    if limit is None:
+        order = sorted(positions, key=keys.__getitem__, reverse=descending)[offset:]
+    else:
+        select = heapq.nlargest if descending else heapq.nsmallest
+        order = select(offset + limit, positions, key=keys.__getitem__)[offset:]
+    return map(expenses.__getitem__, order)
+
+
+def print_expenses(expense_list: list[Expense], stats: ExpenseStats | None = None,
+                   sort: str | None = None, offset: int = 0, limit: int | None = None,
+                   descending: bool = False) -> None:
     """ Prints expenses with appropriate labels 
-    taking into account large numbers in spacing relevant columns."""
-    extra_space = 0
-    for item in expense_list:
-        if item.amount >= 10000000:
-            extra_space_current = len(str(item.amount)) - 8
-            if extra_space_current > extra_space: extra_space = extra_space_current
-    print(f"==ID==  {(' ')*round(extra_space/2)}==Amount=={(' ')*round(extra_space/2)}  =BIG?=  =DESCRIPTION=")
-    total = 0
-    for item in expense_list:
-        total += float(item.amount)
-        if item.amount >= 1000:  # float?
-            big = "(!)"
+    taking into account large numbers in spacing relevant columns.
+    With stored stats column width and total are not computed again.
+    Output is written in chunks of RENDER_CHUNK_LINES lines instead of a print per row.
+    For a page (sort, offset, limit) column width fits the rows shown, TOTAL is for all rows.
+    The date column is shown only when some of the rows have a date."""
+    with profile_stage("render"):
+        paginated = sort is not None or offset > 0 or limit is not None
+        rows = list(select_expenses(expense_list, sort, offset, limit, descending)) if paginated else expense_list
+        extra_space = 0
+        if stats is not None and not paginated:
+            extra_space = stats.extra_space
+        else:
+            for item in rows:
+                if item.amount >= 10000000:
+                    extra_space_current = len(str(item.amount)) - 8
+                    if extra_space_current > extra_space: extra_space = extra_space_current
+        dated = has_dates(rows)
+        date_header = f"{'=DATE=':^10}  " if dated else ""
+        lines = [f"==ID==  {(' ')*round(extra_space/2)}==Amount=={(' ')*round(extra_space/2)}  =BIG?=  "
+                 f"{date_header}=DESCRIPTION="]
+        total_cents = 0
+        for item in rows:
+            cents = item.cents
+            total_cents += cents
+            if cents >= BIG_EXPENSE_CENTS:
+                big = "(!)"
+            else:
+                big = " "
+            date = f"{item.date.isoformat() if item.date is not None else '':10}  " if dated else ""
+            lines.append(
+                f"{item.id:^6}    {format_amount(item.amount, cents):<{8+extra_space}}   {big:^6}  "
+                f"{date}{item.description:20}"
+            )
+            if len(lines) >= RENDER_CHUNK_LINES:
+                sys.stdout.write("\n".join(lines) + "\n")
+                lines.clear()
+        if stats is not None:
+            total_cents = stats.cents
+        elif paginated and isinstance(expense_list, (ExpenseTable, BinaryExpenses)):
+            total_cents = expense_list.total_cents()
+        elif paginated:
+            total_cents = sum(item.cents for item in expense_list)
+        lines.append(f"TOTAL:    {format_cents(total_cents)}")
+        sys.stdout.write("\n".join(lines) + "\n")
+
+
+def iter_chunks(expenses: Iterable[Expense], size: int = RENDER_CHUNK_LINES) -> Iterator[list[Expense]]:
+    iterator = iter(expenses)
+    while chunk := list(itertools.islice(iterator, size)):
+        yield chunk
+
+
+def write_export(expenses: Iterable[Expense], stream: TextIO, format: str = "python") -> None:
+    """Writes expenses to stream as they are read, RENDER_CHUNK_LINES rows at a time.
+    python - the same text as repr of the list, ndjson - a json object per line,
+    csv - id, amount, description (and date if any expense has one) columns,
+    readable by import-csv."""
+    with profile_stage("render"):
+        if format == "python":
+            stream.write("[")
+            separator = ""
+            for chunk in iter_chunks(expenses):
+                stream.write(separator + ", ".join(map(repr, chunk)))
+                separator = ", "
+            stream.write("]\n")
+        elif format == "ndjson":
+            for chunk in iter_chunks(expenses):
+                stream.write("".join(json.dumps(expense_record(item)) + "\n" for item in chunk))
         else:
-            big = " "
-        print(
-            f"{item.id:^6}    {strip_zeros(item.amount):<{8+extra_space}}   {big:^6}  {item.description:20}"
-        )
-    print("TOTAL:   ", f"{strip_zeros(total)}")
+            import csv
+            columns = 4 if has_dates(expenses) else 3
+            writer = csv.writer(stream, lineterminator="\n")
+            writer.writerow(["id", "amount", "description", "date"][:columns])
+            for chunk in iter_chunks(expenses):
+                writer.writerows([item.id, format_amount(item.amount, item.cents), item.description,
+                                  item.date.isoformat() if item.date is not None else ""][:columns]
+                                 for item in chunk)
+
+
+@contextlib.contextmanager
+def export_stream(output: str | None = None, compress: bool = False) -> Iterator[TextIO]:
+    """Text stream export is written to, stdout when output is None"""
+    if output is None and not compress:
+        yield sys.stdout
+        return
+    with contextlib.ExitStack() as stack:
+        if output is None:
+            binary = sys.stdout.buffer
+        else:
+            binary = stack.enter_context(open(output, "wb"))
+        if compress:
+            import gzip
+            binary = stack.enter_context(gzip.GzipFile(fileobj=binary, mode="wb"))
+        import io
+        stream = io.TextIOWrapper(binary, encoding="utf-8", newline="")
+        try:
+            yield stream
+        finally:
+            stream.flush()
+            # The wrapper must not close stdout or the file, ExitStack does that
+            stream.detach()
+
+
+def print_summary(stats: ExpenseStats) -> None:
+    with profile_stage("render"):
+        print("COUNT:   ", stats.count)
+        print("TOTAL:   ", f"{format_cents(stats.cents)}")
+        print("BIG (!): ", stats.big_count)
+
+
+def socket_path(filename=DB_FILENAME) -> str:
+    return filename + SOCKET_SUFFIX
+
+
+def connect_to_daemon(filename=DB_FILENAME) -> "socket.socket | None":
+    """Connection to `serve` of the database, None when it is not running"""
+    path = socket_path(filename)
+    if not os.path.exists(path):
+        return None
+    import socket
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except OSError:
+        # Left behind by a server which did not stop cleanly
+        client.close()
+        return None
+    return client
+
+
+def forward_to_daemon(input: str | None = None) -> bool:
+    """Runs the current command in `serve` of its database if one is running,
+    printing its output and exiting with its exit code. Returns False when
+    there is no server (or this process is the server), the command then
+    runs as usual."""
+    if _resident_storages:
+        return False
+    context = click.get_current_context()
+    client = connect_to_daemon(context.params["filename"])
+    if client is None:
+        return False
+    request = {"command": context.command.name, "command_path": context.command_path,
+               "params": context.params, "cwd": os.getcwd(), "input": input}
+    with client, client.makefile("rb") as stream:
+        client.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        response = json.loads(stream.read())
+    sys.stdout.write(response["stdout"])
+    sys.stderr.write(response["stderr"])
+    if response["exit_code"]:
+        sys.exit(response["exit_code"])
+    return True
+
+
+def run_request(request: dict) -> dict:
+    """Runs a command sent by forward_to_daemon, in the directory of the
+    client and with its stdin, returns what it printed and its exit code"""
+    import io
+    import traceback
+    stdout, stderr = io.StringIO(), io.StringIO()
+    exit_code = 0
+    working_directory, stdin = os.getcwd(), sys.stdin
+    try:
+        if request["command"] not in SERVED_COMMANDS:
+            raise click.UsageError(f"Serwer nie obsługuje polecenia {request['command']}")
+        command = clack.commands[request["command"]]
+        os.chdir(request["cwd"])
+        sys.stdin = io.TextIOWrapper(io.BytesIO((request["input"] or "").encode("utf-8")), encoding="utf-8")
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr), \
+                click.Context(command, info_name=request["command_path"]) as context:
+            context.invoke(command.callback, **request["params"])
+    except click.ClickException as error:
+        error.show(file=stderr)
+        exit_code = error.exit_code
+    except SystemExit as error:
+        exit_code = error.code if isinstance(error.code, int) else int(error.code is not None)
+    except Exception:
+        traceback.print_exc(file=stderr)
+        exit_code = 1
+    finally:
+        os.chdir(working_directory)
+        sys.stdin = stdin
+    return {"stdout": stdout.getvalue(), "stderr": stderr.getvalue(), "exit_code": exit_code}
+
+
+async def persist_pending(storage: ResidentStorage) -> None:
+    """Hands expenses added since the last call to the backing storage in a
+    worker thread, so requests are served meanwhile. Fingerprints of imported
+    rows are saved only after the rows, so a failed write never leaves rows
+    marked as imported. Both are kept for the next call if storing them fails."""
+    import asyncio
+    pending, fingerprints = storage.take_pending()
+    try:
+        if pending:
+            await asyncio.to_thread(storage.backing.append, pending)
+    except Exception as error:
+        storage.pending[:0] = pending
+        storage.pending_fingerprints |= fingerprints
+        click.echo(f"Błąd zapisu bazy danych - {error}", err=True)
+        return
+    try:
+        if fingerprints:
+            await asyncio.to_thread(save_fingerprints, storage.filename, fingerprints)
+    except Exception as error:
+        storage.pending_fingerprints |= fingerprints
+        click.echo(f"Błąd zapisu bazy danych - {error}", err=True)
+
+
+async def serve_requests(storage: ResidentStorage, path: str, ready: Callable[[], None]) -> None:
+    """Answers requests on the unix socket until SIGINT or SIGTERM, then
+    stores what is still pending and removes the socket. One request is
+    one json line each way. Commands run one at a time on the event loop,
+    so they see each other's changes in order. ready is called once the
+    socket accepts connections."""
+    import asyncio
+    import signal
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, stopping.set)
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            line = await reader.readline()
+            if not line:
+                return  # only checking whether the server runs
+            response = run_request(json.loads(line))
+            writer.write(json.dumps(response).encode("utf-8") + b"\n")
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def persist_periodically() -> None:
+        while True:
+            await asyncio.sleep(DAEMON_PERSIST_INTERVAL)
+            await persist_pending(storage)
+
+    absolute_path = os.path.abspath(path)
+    server = await asyncio.start_unix_server(handle, path, limit=DAEMON_MESSAGE_LIMIT)
+    persister = asyncio.create_task(persist_periodically())
+    ready()
+    try:
+        async with server:
+            await stopping.wait()
+    finally:
+        persister.cancel()
+        os.remove(absolute_path)
+        await persist_pending(storage)
+
+
+def print_groups(summaries: list[GroupSummary]) -> None:
+    """Prints group summaries as a table, with the total of all groups shown"""
+    with profile_stage("render"):
+        width = max([len("=GROUP="), *(len(group.key) for group in summaries)])
+        lines = [f"{'=GROUP=':<{width}}  {'=COUNT=':>8}  {'=SUM=':>14}  {'=MIN=':>12}  {'=MAX=':>12}  {'=BIG=':>6}"]
+        for group in summaries:
+            lines.append(f"{group.key:<{width}}  {group.count:>8}  {format_cents(to_cents(group.total)):>14}  "
+                         f"{format_cents(to_cents(group.min_amount)):>12}  "
+                         f"{format_cents(to_cents(group.max_amount)):>12}  "
+                         f"{group.big_share:>6.0%}")
+        lines.append(f"TOTAL:    {format_cents(sum(to_cents(group.total) for group in summaries))}")
+        sys.stdout.write("\n".join(lines) + "\n")
 
 
 @click.group()
-def clack():
-    pass
+@click.option("--profile", is_flag=True, help="Print time and peak memory of every stage to stderr")
+@click.option("--profile-output", type=click.Path(dir_okay=False), help="Save a detailed report to this file")
+@click.option("--profile-format", type=click.Choice(["cprofile", "tracemalloc"]), default="cprofile",
+              help="cProfile stats (read with pstats) or a tracemalloc snapshot")
+@click.option("--cache", is_flag=True, envvar="EXPENSE_CALCULATOR_CACHE",
+              help="Keep parsed json databases in <filename>.cache for read-only commands")
+@click.pass_context
+def clack(ctx: click.Context, profile=False, profile_output=None, profile_format="cprofile", cache=False):
+    global _parse_cache_enabled
+    _parse_cache_enabled = cache
+    if not profile and profile_output is None:
+        return
+    global _stage_totals
+    import tracemalloc
+    if profile or profile_format == "tracemalloc":
+        tracemalloc.start()
+    profiler = None
+    if profile_output is not None and profile_format == "cprofile":
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if profile:
+        _stage_totals = {}
+    start = time.perf_counter()
+
+    def finish() -> None:
+        global _stage_totals
+        elapsed = time.perf_counter() - start
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_output)
+        elif profile_output is not None:
+            tracemalloc.take_snapshot().dump(profile_output)
+        if profile:
+            print_profile(elapsed)
+            _stage_totals = None
+        tracemalloc.stop()
+
+    # Runs also when the command ends with sys.exit
+    ctx.call_on_close(finish)
 
 
 @clack.command()
 @click.option("--filename", default=DB_FILENAME, help="Database filename")
 def export_python(filename=DB_FILENAME):
-    expense_list = read_db_or_init(filename)
-    print(repr(expense_list))
+    write_export(read_db_table(filename), sys.stdout)
+
+
+@clack.command()
+@click.option("--filename", default=DB_FILENAME, help="Database filename")
+@click.option("--format", "format", type=click.Choice(["ndjson", "csv", "python"]), default="ndjson",
+              help="Json object per line, csv with id, amount and description or the list of export-python")
+@click.option("--output", type=click.Path(dir_okay=False), help="File to write to instead of stdout")
+@click.option("--gzip", "compress", is_flag=True, help="Compress output with gzip")
+def export(filename=DB_FILENAME, format="ndjson", output=None, compress=False):
+    """Writes all expenses row by row, without building the whole output in memory"""
+    expenses = read_db_table(filename)
+    with export_stream(output, compress) as stream:
+        write_export(expenses, stream, format)
+
+def expand_csv_paths(patterns: Iterable[str]) -> list[str]:
+    """Expands glob patterns (sorted, so the import order is reproducible),
+    plain paths are kept in the order they were given."""
+    csv_files = []
+    for pattern in patterns:
+        if not any(char in pattern for char in "*?["):
+            csv_files.append(pattern)
+            continue
+        import glob
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            print(f"Błąd - brak plików pasujących do {pattern}")
+            sys.exit(1)
+        csv_files.extend(matches)
+    return csv_files
+
 
 @clack.command()
-@click.argument("csv_file")
+@click.argument("csv_files", nargs=-1, required=True)
 @click.option("--filename", default=DB_FILENAME, help="Database filename")
-def import_csv(csv_file, filename=DB_FILENAME):
-    add_csv_to_db(csv_file, filename)
+@click.option("--journal", is_flag=True, help="Append to journal instead of rewriting the database")
+@click.option("--batch-size", default=IMPORT_BATCH_SIZE, help="Number of csv rows written at once")
+@click.option("--progress", is_flag=True, help="Print number of imported rows to stderr")
+@click.option("--jobs", default=os.cpu_count() or 1, help="Number of processes parsing csv files")
+@click.option("--on-duplicate", type=click.Choice(["skip", "error", "allow"]), default="skip",
+              help="What to do with rows imported before: skip them, stop the import or import them again")
+def import_csv(csv_files, filename=DB_FILENAME, journal=False, batch_size=IMPORT_BATCH_SIZE, progress=False,
+               jobs=1, on_duplicate="skip"):
+    if forward_to_daemon():
+        return
+    csv_files = expand_csv_paths(csv_files)
+    report_progress = None
+    if progress:
+        report_progress = lambda rows: click.echo(f"Przetworzono {rows} wierszy", err=True)
+    if journal and open_storage(filename).supports_journal:
+        skipped = add_csv_to_journal(csv_files, filename, batch_size, report_progress, jobs, on_duplicate)
+    else:
+        skipped = add_csv_to_db(csv_files, filename, batch_size, report_progress, jobs, on_duplicate)
+    if skipped:
+        print(f"Pominięto {skipped} wierszy zaimportowanych już wcześniej")
     print("Pomyślnie zaimportowano")
 
 
 @clack.command()
+@click.argument("source")
+@click.argument("target")
+@click.option("--force", is_flag=True, help="Overwrite target database if it exists")
+def migrate(source, target, force=False):
+    """Copies database to another backend, chosen by extension
+    (.bdb - binary, .sqlite/.sqlite3/.db - SQLite, other - json)"""
+    if not os.path.exists(source):
+        print(f"Błąd - plik {source} nie istnieje")
+        sys.exit(1)
+    try:
+        save_db(read_db_or_init(source), target, overwrite=force)
+    except FileExistsError:
+        print(f"Błąd - plik {target} już istnieje, użyj --force aby go nadpisać")
+        sys.exit(1)
+    print("Pomyślnie przeniesiono")
+
+
+@clack.command()
+@click.option("--filename", default=DB_FILENAME, help="Database filename")
+def compact(filename=DB_FILENAME):
+    compact_db(filename)
+    print("Baza danych skompaktowana")
+
+
+@clack.group()
+def cache():
+    """Parse cache of json databases, used with --cache"""
+
+
+@cache.command()
+@click.option("--filename", default=DB_FILENAME, help="Database filename")
+def clear(filename=DB_FILENAME):
+    """Removes the parse cache of the database"""
+    if remove_parse_cache(filename):
+        print("Usunięto pamięć podręczną bazy danych")
+    else:
+        print("Brak pamięci podręcznej bazy danych")
+
+
+@clack.command()
+@click.argument("query", nargs=-1)
 @click.option("--filename", default=DB_FILENAME, help="Database filename")
-def report(filename=DB_FILENAME) -> None:
-    expenses = read_db_or_init(filename)
+@click.option("--min", "min_amount", type=float, help="Smallest amount shown")
+@click.option("--max", "max_amount", type=float, help="Largest amount shown")
+def search(query, filename=DB_FILENAME, min_amount=None, max_amount=None) -> None:
+    """Finds expenses whose description contains all QUERY words,
+    a word ending with * matches any word starting with it"""
+    text = " ".join(query)
+    # Words without letters or digits (e.g. "-" or "*") match nothing to search for
+    if not SearchIndex.parse_query(text) and min_amount is None and max_amount is None:
+        raise click.UsageError("Podaj szukane słowa albo zakres kosztów")
+    with profile_stage("load"):
+        expenses = search_expenses(filename, text, min_amount, max_amount)
+    if not expenses:
+        print("Nie znaleziono wydatków")
+        return
     print_expenses(expenses)
 
 
 @clack.command()
-@click.argument("amount")
-@click.argument("description")
 @click.option("--filename", default=DB_FILENAME, help="Database filename")
-def add(amount: float, description: str, filename=DB_FILENAME) -> None:
+@click.option("--summary", is_flag=True, help="Print only count and total, using stored aggregates")
+@click.option("--sort", type=click.Choice(["amount", "id"]), help="Order rows by amount or id")
+@click.option("--desc", is_flag=True, help="Sort in descending order")
+@click.option("--offset", default=0, type=click.IntRange(min=0), help="Number of rows to skip")
+@click.option("--limit", type=click.IntRange(min=0), help="Maximum number of rows to show")
+@click.option("--from", "date_from", help="Show only expenses dated this day (YYYY-MM-DD) or later")
+@click.option("--to", "date_to", help="Show only expenses dated this day (YYYY-MM-DD) or earlier")
+def report(filename=DB_FILENAME, summary=False, sort=None, desc=False, offset=0, limit=None,
+           date_from=None, date_to=None) -> None:
+    if forward_to_daemon():
+        return
+    if date_from is not None or date_to is not None:
+        try:
+            start = None if date_from is None else parse_date(date_from)
+            end = None if date_to is None else parse_date(date_to)
+        except ValueError as e:
+            print(f"Błąd - {e.args[0]}")
+            sys.exit(1)
+        storage = open_storage(filename)
+        if summary:
+            print_summary(storage.range_stats(start, end))
+            return
+        expenses, stats = storage.load_range(start, end), None
+    else:
+        stats = read_db_stats(filename)
+        if summary:
+            print_summary(stats if stats is not None else ExpenseStats.from_expenses(read_db_table(filename)))
+            return
+        expenses = read_db_table(filename)
+    try:
+        print_expenses(expenses, stats, sort, offset, limit, desc)
+        sys.stdout.flush()
+    except BrokenPipeError:
+        # Output piped into e.g. head which has already exited
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
+
+
+@clack.command()
+@click.option("--filename", default=DB_FILENAME, help="Database filename")
+@click.option("--by", type=click.Choice(["description", "prefix"]), default="description",
+              help="Group by whole description or by its first words")
+@click.option("--words", default=1, type=click.IntRange(min=1), help="Number of words in a prefix (--by prefix)")
+@click.option("--top", type=click.IntRange(min=1), help="Show only groups with the largest sums")
+def summary(filename=DB_FILENAME, by="description", words=1, top=None) -> None:
+    """Count, sum, min, max and share of big (>= 1000) expenses per description,
+    largest sums first"""
+    expenses = read_db_table(filename)
+    if not isinstance(expenses, ExpenseTable):
+        expenses = ExpenseTable(expenses)
+    summaries = summarize_groups(expenses, words if by == "prefix" else None)
+    summaries.sort(key=operator.attrgetter("total"), reverse=True)
+    # TOTAL is for shown groups only
+    print_groups(summaries[:top])
+
+
+@clack.command()
+@click.option("--filename", default=DB_FILENAME, help="Database filename")
+def serve(filename=DB_FILENAME) -> None:
+    """Keeps the database in memory and runs add, report and import-csv of
+    other calls of this program sent through <filename>.sock, stop with Ctrl+C"""
+    import asyncio
+    path = socket_path(filename)
+    running = connect_to_daemon(filename)
+    if running is not None:
+        running.close()
+        print("Błąd - serwer tej bazy danych już działa")
+        sys.exit(1)
+    if os.path.exists(path):
+        os.remove(path)
+    # Requests run in the directories of their clients, the database is found by absolute path
+    global _serving_thread
+    storage = ResidentStorage(os.path.abspath(filename))
+    _resident_storages[storage.filename] = storage
+    _serving_thread = threading.get_ident()
+    try:
+        asyncio.run(serve_requests(storage, path,
+                                   lambda: print(f"Serwer bazy danych {filename} działa", flush=True)))
+    finally:
+        del _resident_storages[storage.filename]
+        _serving_thread = None
+    print("Serwer zatrzymany")
+
 
+def parse_amount(amount: str) -> float:
+    """Converts amount typed by the user, accepting comma as decimal separator"""
     try:
-        amount = float(amount.replace(",", "."))
+        value = float(amount.replace(",", "."))
     except ValueError:
-        print("Błąd - Koszt musi być liczbą")
+        raise ValueError("Koszt musi być liczbą") from None
+    # Negative and too big amounts get their messages from check_expense
+    if 0 <= value <= 10000000000000 and to_cents(value) / 100 != value:
+        raise ValueError(SUBCENT_ERROR)
+    return value
+
+
+def read_batch_rows(stream: Iterable[str], date: datetime.date | None = None
+                    ) -> list[tuple[float, str, datetime.date | None]]:
+    """Reads `amount<TAB>description` lines for add --batch, checking every row
+    before anything is saved. Empty lines are skipped, every row gets the date."""
+    rows = []
+    with profile_stage("validate"):
+        for line_number, line in enumerate(stream, 1):
+            line = line.rstrip("\r\n")
+            if not line:
+                continue
+            amount, separator, description = line.partition("\t")
+            try:
+                if not separator:
+                    raise ValueError("Wiersz musi mieć postać koszt<TAB>opis")
+                amount = parse_amount(amount)
+                check_expense(amount, description)
+            except ValueError as e:
+                print(f"Błąd - {e.args[0]} (wiersz {line_number})")
+                sys.exit(1)
+            rows.append((amount, description, date))
+    return rows
+
+
+@clack.command()
+@click.argument("amount", required=False)
+@click.argument("description", required=False)
+@click.option("--filename", default=DB_FILENAME, help="Database filename")
+@click.option("--journal", is_flag=True, help="Append to journal instead of rewriting the database")
+@click.option("--batch", is_flag=True, help="Read amount<TAB>description lines from stdin")
+@click.option("--group-commit", is_flag=True, help="Save together with other writers waiting for the database")
+@click.option("--date", help="Date of the expense (YYYY-MM-DD), with --batch of every row")
+def add(amount: float, description: str, filename=DB_FILENAME, journal=False, batch=False,
+        group_commit=False, date=None) -> None:
+
+    batch_input = sys.stdin.read() if batch else None
+    if forward_to_daemon(batch_input):
+        return
+    try:
+        date = None if date is None else parse_date(date)
+    except ValueError as e:
+        print(f"Błąd - {e.args[0]}")
         sys.exit(1)
-    expense_list = read_db_or_init(filename)
+    if batch:
+        rows = read_batch_rows(batch_input.splitlines(keepends=True), date)
+    else:
+        if amount is None or description is None:
+            raise click.UsageError("Podaj koszt i opis albo użyj --batch")
+        try:
+            rows = [(parse_amount(amount), description, date)]
+        except ValueError as e:
+            print(f"Błąd - {e.args[0]}")
+            sys.exit(1)
+    storage = open_storage(filename)
+    journal = journal and storage.supports_journal
+    # A server applies requests one by one anyway
+    if group_commit and not isinstance(storage, ResidentStorage):
+        try:
+            add_with_group_commit(rows, filename, journal)
+        except ValueError as e:
+            print(f"Błąd - {e.args[0]}")
+            sys.exit(1)
+        print("Dodano")
+        return
+    if journal:
+        add_many_to_journal(rows, filename)
+        print("Dodano")
+        return
     try:
-        add_expense(expense_list, amount, description)
+        if batch:
+            storage.add_many(rows)
+        else:
+            storage.add(*rows[0])
     except ValueError as e:
         print(f"Błąd - {e.args[0]}")
         sys.exit(1)
-    save_db(expense_list, filename=filename)
     print("Dodano")
    
 
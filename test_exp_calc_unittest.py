@@ -1,6 +1,12 @@
 """Unittest module to test a few basic functionalities"""
 from io import StringIO
+import datetime
+import importlib.util
+import json
+import os
 import sys
+import tempfile
+import time
 import unittest
 from unittest.mock import patch, mock_open
 
@@ -8,10 +14,27 @@ from expense_calculator import (
     add_expense,
     create_Expense_item_from_dict,
     find_next_id,
+    format_cents,
+    parse_csv_file,
     print_expenses,
+    profile_stage,
+    register_timing_hook,
+    unregister_timing_hook,
+    IdAllocator,
     read_db_or_init,
     read_expenses,
+    read_spilled_batches,
+    select_expenses,
     strip_zeros,
+    summarize_groups,
+    to_cents,
+    validate_amounts,
+    validate_rows,
+    write_json_records,
+    CsvRowError,
+    ExpenseStats,
+    ExpenseTable,
+    GroupSummary,
     CSV_import,
     Expense,
 )
@@ -59,6 +82,35 @@ class TestCsvImportClass(unittest.TestCase):
         self.assertEqual(str(message.exception), "Opis nie może być pusty")
 
 
+class TestValidateAmounts(unittest.TestCase):
+    """Verifies batch validation of csv amount column"""
+    def test_correct_column(self):
+        self.assertEqual(validate_amounts(["60", "40.5", ".5", "7."]), [60.0, 40.5, 0.5, 7.0])
+        self.assertEqual(validate_amounts(["12.340", "0.05"]), [12.34, 0.05])
+
+    def test_first_bad_row_is_reported(self):
+        for amounts, message, row in (
+            (["1", "2", "1.2.3", "-4"], "Wszystkie koszty muszą być liczbami", 4),
+            (["1", "-4", "abc"], "Koszt nie może być ujemny", 3),
+            (["1", "2\n3"], "Wszystkie koszty muszą być liczbami", 3),
+            (["1", None], "Wszystkie koszty muszą być liczbami", 3),
+            (["1", "12.345", "-4"], "Koszt może mieć najwyżej dwie cyfry po przecinku", 3),
+        ):
+            with self.assertRaises(CsvRowError) as error:
+                validate_amounts(amounts, first_row=2)
+            self.assertEqual(error.exception.args, (message, row))
+
+    def test_empty_description_before_bad_amount(self):
+        with self.assertRaises(CsvRowError) as error:
+            validate_rows(["1", "2", "x"], ["Kawa", "", "Herbata"])
+        self.assertEqual(error.exception.args, ("Opis nie może być pusty", 2))
+
+    def test_bad_amount_wins_on_the_same_row(self):
+        with self.assertRaises(CsvRowError) as error:
+            validate_rows(["1", "-5"], ["Kawa", ""])
+        self.assertEqual(error.exception.args, ("Koszt nie może być ujemny", 2))
+
+
 class TestFindID(unittest.TestCase):
     """ Verifies if id is correctly selected in a number of situations"""
     def test_find_next_id_empty(self):
@@ -80,6 +132,79 @@ class TestFindID(unittest.TestCase):
         self.assertEqual(find_next_id(expenses_data), 2)
 
 
+class TestIdAllocator(unittest.TestCase):
+    """ Verifies if allocator gives exactly the ids find_next_id would give"""
+    def test_allocator_empty(self):
+        allocator = IdAllocator([])
+        self.assertEqual([allocator.next_id() for _ in range(3)], [1, 2, 3])
+
+    def test_allocator_matches_find_next_id_with_gaps(self):
+        expenses_data = [Expense(id=id, amount=1, description="Gap") for id in (2, 3, 6, 9)]
+        allocator = IdAllocator(expenses_data)
+        for _ in range(8):
+            expected = find_next_id(expenses_data)
+            got = allocator.next_id()
+            self.assertEqual(got, expected)
+            expenses_data.append(Expense(id=got, amount=1, description="Filled"))
+
+    def test_allocator_state_round_trip_with_claim(self):
+        allocator = IdAllocator([Expense(id=id, amount=1, description="Gap") for id in (1, 4, 5)])
+        restored = IdAllocator.from_state(allocator.to_state())
+        restored.claim(3)
+        restored.claim(8)
+        self.assertEqual([restored.next_id() for _ in range(5)], [2, 6, 7, 9, 10])
+
+
+class TestExpenseTable(unittest.TestCase):
+    """Verifies if column store behaves like the list of expenses it replaces"""
+    def setUp(self):
+        self.expense_list = [Expense(1, 34.0, "Hit Box"), Expense(2, 1453.5, "Crazy curry"),
+                             Expense(4, 12.0, "Hit Box")]
+        self.table = ExpenseTable(self.expense_list)
+
+    def test_same_iteration_and_repr(self):
+        self.assertEqual(list(self.table), self.expense_list)
+        self.assertEqual(repr(self.table), repr(self.expense_list))
+        self.assertEqual(repr(ExpenseTable()), repr([]))
+        self.assertEqual(self.table[-1], Expense(4, 12.0, "Hit Box"))
+        self.assertEqual(len(self.table.descriptions), 2)
+
+    def test_aggregates_and_filter(self):
+        self.assertEqual(self.table.total(), 1499.5)
+        self.assertEqual(self.table.max_amount(), 1453.5)
+        self.assertEqual(list(self.table.filter(min_amount=20, text="Hit")), [Expense(1, 34.0, "Hit Box")])
+        self.assertEqual(len(self.table.filter(max_amount=10)), 0)
+
+    def test_dates(self):
+        dated = [Expense(5, 1.0, "Kawa", datetime.date(2024, 4, 30)), Expense(6, 2.0, "Kawa", datetime.date(2024, 5, 1))]
+        table = ExpenseTable(self.expense_list + dated)
+        self.assertEqual(list(table), self.expense_list + dated)
+        self.assertEqual(repr(table), repr(self.expense_list + dated))
+        self.assertEqual(repr(dated[0]), "Expense(id=5, amount=1.0, description='Kawa', date=datetime.date(2024, 4, 30))")
+        self.assertEqual(list(table.between(datetime.date(2024, 5, 1))), dated[1:])
+        self.assertEqual(list(table.between(end=datetime.date(2024, 4, 30))), dated[:1])
+        self.assertEqual(list(table.between()), dated)
+
+    def test_unsorted_page(self):
+        for expenses in (self.table, self.expense_list):
+            self.assertEqual(list(select_expenses(expenses, offset=1, limit=1)), self.expense_list[1:2])
+            self.assertEqual(list(select_expenses(expenses, offset=2, limit=5)), self.expense_list[2:])
+            self.assertEqual(list(select_expenses(expenses, offset=1)), self.expense_list[1:])
+            self.assertEqual(list(select_expenses(expenses, offset=5, limit=2)), [])
+
+
+class TestExpenseStats(unittest.TestCase):
+    """Verifies if incremental aggregates match a full pass over the list"""
+    def test_add_expense_updates_stats(self):
+        expense_list = []
+        stats = ExpenseStats()
+        for amount in (0.1, 0.2, 1000, 123456789.5):
+            add_expense(expense_list, amount=amount, description="Item", stats=stats)
+        self.assertEqual(stats, ExpenseStats(count=4, cents=12345778980, big_count=2, extra_space=3))
+        self.assertEqual(stats.total, 123457789.8)
+        self.assertEqual(stats, ExpenseStats.from_expenses(expense_list))
+
+
 class TestReadDB(unittest.TestCase):
     """Tests the expected return value for database - existing or not"""
     @patch("json.load")
@@ -99,6 +224,19 @@ class TestReadDB(unittest.TestCase):
         self.assertEqual(got, [])
 
 
+class TestWriteJsonRecords(unittest.TestCase):
+    """Checks if batched writing gives the same file as json.dump of the whole list"""
+    def test_same_as_json_dump(self):
+        expense_list = [Expense(1, 12.5, "Kawa"), Expense(2, 3, 'Cytat "test"'), Expense(3, 7.0, "Żółw")]
+        for batches in ([], [expense_list], [expense_list[:1], [], expense_list[1:]]):
+            stream = StringIO()
+            write_json_records(stream, batches)
+            expected = json.dumps(
+                [{"id": item.id, "amount": float(item.amount), "description": item.description}
+                 for batch in batches for item in batch], indent=2)
+            self.assertEqual(stream.getvalue(), expected)
+
+
 class TestAddExpense(unittest.TestCase):
     """Tests if expenses are correctly added the list for single and multiple items"""
     def test_add_expense_single(self):
@@ -190,6 +328,45 @@ class TestReadExpenses(unittest.TestCase):
             self.assertEqual(context.code, 1)
 
 
+class TestSpilledBatches(unittest.TestCase):
+    """Rows validated by a worker of a multi-file import are read back batch by batch"""
+    def test_round_trip(self):
+        with tempfile.TemporaryDirectory() as directory:
+            csv_file = os.path.join(directory, "rows.csv")
+            with open(csv_file, "w", encoding="utf-8") as stream:
+                stream.write("amount,description,date\n12.5,Kawa,2024-05-02\n7,Herbata,\n3,Ciastko,\n")
+            path = parse_csv_file(csv_file, directory, batch_size=2)
+            self.assertEqual(list(read_spilled_batches(path)), [
+                [(12.5, "Kawa", datetime.date(2024, 5, 2)), (7.0, "Herbata", None)], [(3.0, "Ciastko", None)]])
+            self.assertFalse(os.path.exists(path))
+
+
+class TestFormatCents(unittest.TestCase):
+    """Tests amounts kept in cents and their rendering"""
+    def test_format_cents(self):
+        for amount, expected in ((34, "34"), (34.5, "34.5"), (0.05, "0.05"), (12002232.25, "12002232.25")):
+            self.assertEqual(format_cents(to_cents(amount)), expected)
+            self.assertEqual(format_cents(to_cents(amount)), strip_zeros(float(amount)))
+
+    def test_total_is_exact(self):
+        table = ExpenseTable(Expense(id, 0.1, "Item") for id in range(1, 11))
+        self.assertEqual(table.total_cents(), 100)
+        self.assertEqual(format_cents(ExpenseStats.from_expenses(table).cents), "1")
+        self.assertEqual(table[0].amount, 0.1)
+
+    def test_older_subcent_amounts(self):
+        """Amounts of older databases read back as stored, big rows are counted as marked"""
+        expenses = [Expense(1, 12.345, "Sub"), Expense(2, 0.125, "Sub2"), Expense(3, 999.995, "Big")]
+        table = ExpenseTable(expenses)
+        self.assertEqual(list(table), expenses)
+        self.assertEqual(list(table.select([2])), expenses[2:])
+        self.assertEqual(ExpenseStats.from_expenses(table).big_count, 1)
+        with patch("sys.stdout", new_callable=StringIO) as output:
+            print_expenses(table)
+        self.assertEqual(output.getvalue().count("(!)"), 1)
+        self.assertIn("12.345", output.getvalue())
+
+
 class TestStripZeroes(unittest.TestCase):
     """ Tests the correct removal of trailing zeroes"""
     def test_number_following_zeroes(self):
@@ -222,5 +399,58 @@ class TestPrintExpenses(unittest.TestCase):
         self.assertIn("TOTAL:    1123", output)
 
 
+class TestSummarizeGroups(unittest.TestCase):
+    """Group aggregates by exact description and by normalized prefix"""
+    table = ExpenseTable([Expense(1, 12, "Obiad w domu"), Expense(2, 3.5, "Kawa"),
+                          Expense(3, 1500, "obiad, restauracja"), Expense(4, 7, "Kawa")])
+
+    def test_by_description(self):
+        self.assertEqual(summarize_groups(self.table), [
+            GroupSummary("Obiad w domu", 1, 12.0, 12.0, 12.0, 0),
+            GroupSummary("Kawa", 2, 10.5, 3.5, 7.0, 0),
+            GroupSummary("obiad, restauracja", 1, 1500.0, 1500.0, 1500.0, 1)])
+
+    def test_by_prefix(self):
+        got = summarize_groups(self.table, words=1)
+        self.assertEqual(got[0], GroupSummary("obiad", 2, 1512.0, 12.0, 1500.0, 1))
+        self.assertEqual(got[0].big_share, 0.5)
+        self.assertEqual([group.key for group in summarize_groups(self.table, words=2)],
+                         ["obiad w", "kawa", "obiad restauracja"])
+
+    def test_empty(self):
+        self.assertEqual(summarize_groups(ExpenseTable()), [])
+
+    @unittest.skipUnless(importlib.util.find_spec("numpy"), "numpy is not installed")
+    def test_numpy_matches_builtins(self):
+        amounts, descriptions = [0.1, 999.99, 1000, 12.34, 0.2], ["Kawa", "Obiad w domu", "kawa duża"]
+        table = ExpenseTable(Expense(id, amounts[id % 5], descriptions[id % 3]) for id in range(1, 200))
+        for words in (None, 1):
+            with self.subTest(words=words):
+                with patch.dict(sys.modules, {"numpy": None}):
+                    expected = summarize_groups(table, words)
+                self.assertEqual(summarize_groups(table, words), expected)
+
+
+class TestTimingHooks(unittest.TestCase):
+    """Hooks get every stage, nested stages are not counted twice"""
+    def test_nested_stages(self):
+        timings = []
+        hook = lambda stage, seconds, peak: timings.append((stage, seconds, peak))
+        register_timing_hook(hook)
+        try:
+            with profile_stage("save"):
+                with profile_stage("assign ids"):
+                    time.sleep(0.05)
+        finally:
+            unregister_timing_hook(hook)
+        with profile_stage("load"):
+            pass
+
+        self.assertEqual([stage for stage, _, _ in timings], ["assign ids", "save"])
+        self.assertGreaterEqual(timings[0][1], 0.05)
+        self.assertLess(timings[1][1], 0.05)
+        self.assertIsNone(timings[0][2])
+
+
 if __name__ == "__main__":
     unittest.main()
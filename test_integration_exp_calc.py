@@ -1,22 +1,51 @@
 """ Pytest document with integration tests using test database and CliRunner"""
 
+import asyncio
+import contextlib
+from datetime import date
+import glob
+import gzip
 import json
 import os
+import pstats
+import shutil
+import sqlite3
+import subprocess
+import sys
+import threading
 from typing import Literal
 
 from expense_calculator import (
     Expense,
+    ResidentStorage,
     add,
+    clack,
+    compact,
+    compact_db,
+    export,
     export_python,
     import_csv,
+    migrate,
+    open_storage,
+    persist_pending,
+    read_db_meta,
+    read_db_or_init,
     report,
+    save_db,
+    search,
+    summary,
+    take_rejected_entry,
 )
 
 from click.testing import CliRunner
 import pytest
 
+import expense_calculator
+
 
 LIST_OF_ITEMS = [(987,"Chicken"),(456,"Bananas"),(789,"Pizza")]
+# Cumulative `python -X importtime` of expense_calculator, click and dataclasses take most of it
+IMPORT_TIME_BUDGET_US = 80000
 
 
 @pytest.fixture
@@ -38,7 +67,8 @@ def use_temp_db():
     with open(filename_db, "w") as file:
         file.write("[]")  
     yield filename_db
-    os.remove(filename_db)
+    for path in glob.glob(f"{filename_db}*"):
+        os.remove(path)
 
 
 def test_import_csv_and_export_python(runner: CliRunner, use_temp_db: Literal['test_db.json'], use_temp_csv: Literal['temp.csv']):
@@ -82,4 +112,605 @@ def test_add_import_csv_and_report(runner: CliRunner, use_temp_db: Literal['test
     assert "1" and "2" and "3" in printed_output
     assert "987" and "456" and "789" in printed_output
     assert "Chicken" and "Bananas" and "Pizza" in printed_output
-    assert "4" and "Test CSV 1" and "150" in printed_output
\ No newline at end of file
+    assert "4" and "Test CSV 1" and "150" in printed_output
+
+def test_import_csv_in_batches_with_progress(runner: CliRunner, use_temp_db: Literal['test_db.json'], use_temp_csv: Literal['temp.csv']):
+    temp_db = use_temp_db
+    temp_csv = use_temp_csv
+    result = runner.invoke(import_csv, [temp_csv, f"--filename={temp_db}", "--batch-size=1", "--progress"])
+    assert "Przetworzono 1 wierszy" in result.output
+    assert "Przetworzono 2 wierszy" in result.output
+    with open(temp_db, "r") as stream:
+        assert json.load(stream) == [{'id': 1, 'amount': 150, 'description': 'Test CSV 1'},
+                                     {'id': 2, 'amount': 300, 'description': 'Test CSV 2'}]
+
+
+def test_import_broken_csv_leaves_db_untouched(runner: CliRunner, use_temp_db: Literal['test_db.json']):
+    temp_db = use_temp_db
+    with open("broken.csv", "w") as file:
+        file.write('amount,description\n150,Good row\nabc,Bad row\n')
+    try:
+        result = runner.invoke(import_csv, ["broken.csv", f"--filename={temp_db}", "--batch-size=1"])
+    finally:
+        os.remove("broken.csv")
+    assert result.exit_code == 1
+    with open(temp_db, "r") as stream:
+        assert json.load(stream) == []
+    assert not os.path.exists(f"{temp_db}.tmp")
+
+
+@pytest.fixture
+def use_branch_csvs():
+    filenames = []
+    for branch in range(3):
+        filename_csv = f"branch_{branch}.csv"
+        with open(filename_csv, "w") as file:
+            file.write(f'amount,description\n{branch}1,Branch {branch} A\n{branch}2,Branch {branch} B\n')
+        filenames.append(filename_csv)
+    yield filenames
+    for filename_csv in filenames:
+        os.remove(filename_csv)
+
+
+def test_import_many_csv_files_in_parallel(runner: CliRunner, use_temp_db: Literal['test_db.json'], use_branch_csvs: list[str]):
+    temp_db = use_temp_db
+    result = runner.invoke(import_csv, ["branch_*.csv", f"--filename={temp_db}", "--jobs=3", "--batch-size=1"])
+    assert result.exit_code == 0
+    with open(temp_db, "r") as stream:
+        db_content = json.load(stream)
+    assert [(item["id"], item["description"]) for item in db_content] == [
+        (1, "Branch 0 A"), (2, "Branch 0 B"), (3, "Branch 1 A"),
+        (4, "Branch 1 B"), (5, "Branch 2 A"), (6, "Branch 2 B")]
+
+
+def test_import_many_csv_files_reports_broken_file(runner: CliRunner, use_temp_db: Literal['test_db.json'], use_branch_csvs: list[str]):
+    temp_db = use_temp_db
+    with open(use_branch_csvs[1], "a") as file:
+        file.write("-5,Refund\n")
+    result = runner.invoke(import_csv, [*use_branch_csvs, f"--filename={temp_db}", "--jobs=2"])
+    assert result.exit_code == 1
+    assert "Błąd - Koszt nie może być ujemny (branch_1.csv, wiersz 4)" in result.output
+    with open(temp_db, "r") as stream:
+        assert json.load(stream) == []
+
+
+def test_add_to_journal_and_compact(runner: CliRunner, use_temp_db: Literal['test_db.json'], use_temp_csv: Literal['temp.csv']):
+    temp_db = use_temp_db
+    temp_csv = use_temp_csv
+    for amount, description in LIST_OF_ITEMS:
+        result = runner.invoke(add, [str(amount), description, f"--filename={temp_db}", "--journal"])
+    assert result.output == "Dodano\n"
+    runner.invoke(import_csv, [temp_csv, f"--filename={temp_db}", "--journal"])
+    with open(temp_db, "r") as stream:
+        assert json.load(stream) == []
+    assert os.path.exists(f"{temp_db}.journal")
+
+    expected = repr([Expense(id=1, amount=987.0, description='Chicken'), Expense(id=2, amount=456.0, description='Bananas'),
+                     Expense(id=3, amount=789.0, description='Pizza'), Expense(id=4, amount=150.0, description='Test CSV 1'),
+                     Expense(id=5, amount=300.0, description='Test CSV 2')])
+    result = runner.invoke(export_python, f"--filename={temp_db}")
+    assert result.output.strip() == expected
+
+    runner.invoke(compact, f"--filename={temp_db}")
+    assert not os.path.exists(f"{temp_db}.journal")
+    result = runner.invoke(export_python, f"--filename={temp_db}")
+    assert result.output.strip() == expected
+
+
+def test_hand_edited_db_is_validated_again(runner: CliRunner, use_temp_db: Literal['test_db.json']):
+    temp_db = use_temp_db
+    runner.invoke(add, ["987", "Chicken", f"--filename={temp_db}"])
+    assert read_db_meta(temp_db) is not None
+    assert read_db_or_init(temp_db) == [Expense(id=1, amount=987.0, description="Chicken")]
+
+    with open(temp_db, "w") as stream:
+        json.dump([{"id": 1, "amount": -987.0, "description": "Chicken"}], stream)
+    assert read_db_meta(temp_db) is None
+    with pytest.raises(ValueError, match="Koszt nie może być ujemny"):
+        read_db_or_init(temp_db)
+
+
+def test_binary_db_and_migrate_round_trip(runner: CliRunner, use_temp_db: Literal['test_db.json'], use_temp_csv: Literal['temp.csv']):
+    temp_db = use_temp_db
+    binary_db = f"{temp_db}.bdb"
+    for amount, description in LIST_OF_ITEMS:
+        runner.invoke(add, [str(amount), description, f"--filename={binary_db}"])
+    runner.invoke(import_csv, [use_temp_csv, f"--filename={binary_db}"])
+    cli_report = runner.invoke(report, ["--filename", binary_db])
+    assert "Test CSV 2" in cli_report.output
+    assert "TOTAL:    2682" in cli_report.output
+
+    result = runner.invoke(migrate, [binary_db, temp_db])
+    assert result.exit_code == 1
+    runner.invoke(migrate, [binary_db, temp_db, "--force"])
+    runner.invoke(add, ["12.5", "Zażółć gęślą jaźń", f"--filename={temp_db}"])
+    os.remove(binary_db)
+    runner.invoke(migrate, [temp_db, binary_db])
+    json_export = runner.invoke(export_python, f"--filename={temp_db}").output
+    binary_export = runner.invoke(export_python, f"--filename={binary_db}").output
+    assert "Zażółć gęślą jaźń" in binary_export
+    assert binary_export == json_export
+
+
+def test_report_summary_uses_stored_stats(runner: CliRunner, use_temp_db: Literal['test_db.json']):
+    temp_db = use_temp_db
+    for amount, description in LIST_OF_ITEMS + [(1500, "Bike")]:
+        runner.invoke(add, [str(amount), description, f"--filename={temp_db}"])
+    runner.invoke(add, ["20", "Journaled", f"--filename={temp_db}", "--journal"])
+    summary = runner.invoke(report, ["--filename", temp_db, "--summary"]).output
+    assert summary == "COUNT:    5\nTOTAL:    3752\nBIG (!):  1\n"
+
+    with open(temp_db, "a") as stream:
+        stream.write("\n")
+    assert read_db_meta(temp_db) is None
+    assert runner.invoke(report, ["--filename", temp_db, "--summary"]).output == summary
+
+
+def test_report_pages_sorted_by_amount(runner: CliRunner, use_temp_db: Literal['test_db.json']):
+    temp_db = use_temp_db
+    for amount, description in LIST_OF_ITEMS + [(12000000.25, "Flat")]:
+        runner.invoke(add, [str(amount), description, f"--filename={temp_db}"])
+
+    page = runner.invoke(report, ["--filename", temp_db, "--sort", "amount", "--limit", "2"]).output
+    assert page.splitlines() == [
+        "==ID==  ==Amount==  =BIG?=  =DESCRIPTION=",
+        "  2       456                Bananas             ",
+        "  3       789                Pizza               ",
+        "TOTAL:    12002232.25",
+    ]
+    page = runner.invoke(report, ["--filename", temp_db, "--sort", "amount", "--desc", "--offset", "1", "--limit", "1"]).output
+    assert "Chicken" in page and "Flat" not in page
+    page = runner.invoke(report, ["--filename", temp_db, "--limit", "1", "--offset", "3"]).output
+    assert page.splitlines()[:2] == [
+        "==ID==    ==Amount==    =BIG?=  =DESCRIPTION=",
+        "  4       12000000.25    (!)    Flat                ",
+    ]
+
+
+def test_sqlite_storage_and_migrate(runner: CliRunner, use_temp_db: Literal['test_db.json'], use_temp_csv: Literal['temp.csv']):
+    temp_db = use_temp_db
+    sqlite_db = f"{temp_db}.sqlite"
+    for amount, description in LIST_OF_ITEMS:
+        runner.invoke(add, [str(amount), description, f"--filename={sqlite_db}"])
+    runner.invoke(import_csv, [use_temp_csv, f"--filename={sqlite_db}"])
+    with open("broken.csv", "w") as file:
+        file.write('amount,description\n150,Good row\nabc,Bad row\n')
+    try:
+        result = runner.invoke(import_csv, ["broken.csv", f"--filename={sqlite_db}", "--batch-size=1"])
+    finally:
+        os.remove("broken.csv")
+    assert result.exit_code == 1
+
+    summary = runner.invoke(report, ["--filename", sqlite_db, "--summary"]).output
+    assert summary == "COUNT:    5\nTOTAL:    2682\nBIG (!):  0\n"
+    runner.invoke(migrate, [sqlite_db, temp_db, "--force"])
+    assert runner.invoke(export_python, f"--filename={temp_db}").output.strip() == repr([
+        Expense(id=1, amount=987.0, description='Chicken'), Expense(id=2, amount=456.0, description='Bananas'),
+        Expense(id=3, amount=789.0, description='Pizza'), Expense(id=4, amount=150.0, description='Test CSV 1'),
+        Expense(id=5, amount=300.0, description='Test CSV 2')])
+
+    assert runner.invoke(add, ["1", "", f"--filename={sqlite_db}"]).exit_code == 1
+    assert runner.invoke(report, ["--filename", sqlite_db, "--summary"]).output == summary
+
+
+def test_add_batch_from_stdin(runner: CliRunner, use_temp_db: Literal['test_db.json']):
+    temp_db = use_temp_db
+    result = runner.invoke(add, ["--batch", f"--filename={temp_db}"], input="12,5\tKawa\n\n7\tHerbata z cytryną\n")
+    assert result.output == "Dodano\n"
+    result = runner.invoke(add, ["--batch", f"--filename={temp_db}"], input="1\tOk\nabc\tZły koszt\n")
+    assert result.output == "Błąd - Koszt musi być liczbą (wiersz 2)\n"
+    result = runner.invoke(add, ["--batch", f"--filename={temp_db}"], input="1\tOk\n2\n")
+    assert result.exit_code == 1
+    assert runner.invoke(export_python, f"--filename={temp_db}").output.strip() == repr([
+        Expense(id=1, amount=12.5, description='Kawa'), Expense(id=2, amount=7.0, description='Herbata z cytryną')])
+
+
+def test_import_time():
+    """Plain `add` must not import modules only other commands need, and the
+    module import has to stay within IMPORT_TIME_BUDGET_US"""
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    here = os.path.dirname(os.path.abspath(__file__))
+    lazy_modules = ["csv", "sqlite3", "mmap", "glob", "concurrent.futures", "asyncio", "socket"]
+    result = subprocess.run(
+        [sys.executable, "-c", f"import sys, expense_calculator; print([m for m in {lazy_modules} if m in sys.modules])"],
+        capture_output=True, text=True, env=env, cwd=here)
+    assert result.stdout.strip() == "[]"
+
+    timings = []
+    for _ in range(3):  # the first run may still be compiling bytecode
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import expense_calculator"],
+                                capture_output=True, text=True, env=env, cwd=here)
+        line = next(line for line in result.stderr.splitlines() if line.endswith("| expense_calculator"))
+        timings.append(int(line.split("|")[1]))
+    assert min(timings) < IMPORT_TIME_BUDGET_US
+
+
+@pytest.mark.parametrize("mode", [[], ["--journal"], ["--group-commit"], ["--group-commit", "--journal"]])
+def test_concurrent_adds(tmp_path, mode: list[str]):
+    """Dozens of add processes at once, none of the rows may be lost or share an id"""
+    temp_db = str(tmp_path / "budget.json")
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "expense_calculator.py")
+    writers = 32
+    processes = [subprocess.Popen([sys.executable, script, "add", str(number), f"Zakup {number}",
+                                   f"--filename={temp_db}", *mode], stdout=subprocess.PIPE, text=True)
+                 for number in range(1, writers + 1)]
+    outputs = [process.communicate()[0] for process in processes]
+    assert outputs == ["Dodano\n"] * writers
+    compact_db(temp_db)
+    expenses = read_db_or_init(temp_db)
+    assert sorted(item.id for item in expenses) == list(range(1, writers + 1))
+    assert sorted(item.amount for item in expenses) == list(range(1, writers + 1))
+    assert not os.path.exists(temp_db + ".tmp")
+
+
+def test_group_commit_bad_row(runner: CliRunner, use_temp_db: Literal['test_db.json']):
+    """An incorrect row is never queued, one queued before does not block later writers
+    and is moved to the rejects file, where its writer gets the error from"""
+    temp_db = use_temp_db
+    result = runner.invoke(add, ["--group-commit", f"--filename={temp_db}", "--", "-5", "x"])
+    assert (result.exit_code, result.output) == (1, "Błąd - Koszt nie może być ujemny\n")
+    assert runner.invoke(add, ["--group-commit", "10", "Dobry", f"--filename={temp_db}"]).output == "Dodano\n"
+    # Left in the queue by a writer of an older version
+    with open(temp_db + ".queue", "a") as stream:
+        stream.write(json.dumps({"token": "stale", "rows": [[-5.0, "x", None]]}) + "\n")
+    assert runner.invoke(add, ["--group-commit", "20", "Drugi", f"--filename={temp_db}"]).output == "Dodano\n"
+    assert [(item.amount, item.description) for item in read_db_or_init(temp_db)] == [(10, "Dobry"), (20, "Drugi")]
+    with open(temp_db + ".queue") as stream:
+        assert stream.read() == ""
+    with open(temp_db + ".queue.rejects") as stream:
+        assert [(entry["token"], entry["error"]) for entry in map(json.loads, stream)] == [
+            ("stale", "Koszt nie może być ujemny")]
+    take_rejected_entry(temp_db, "other")
+    with pytest.raises(ValueError, match="Koszt nie może być ujemny"):
+        take_rejected_entry(temp_db, "stale")
+    assert not os.path.exists(temp_db + ".queue.rejects")
+
+
+def test_profile(runner: CliRunner, use_temp_db: Literal['test_db.json'], tmp_path):
+    temp_db = use_temp_db
+    with open(temp_db + ".csv", "w", encoding="utf-8") as stream:
+        stream.write("amount,description\n12.5,Kawa\n7,Herbata\n")
+    result = runner.invoke(clack, ["--profile", "import-csv", temp_db + ".csv", f"--filename={temp_db}"])
+    for stage in ["load", "validate", "assign ids", "save", "razem"]:
+        assert f"\n{stage} " in result.output
+
+    profile_file = str(tmp_path / "report.prof")
+    result = runner.invoke(clack, ["--profile", f"--profile-output={profile_file}", "report", f"--filename={temp_db}"])
+    assert "TOTAL:    19.5\n" in result.output
+    assert "\nrender " in result.output
+    assert "print_expenses" in str(pstats.Stats(profile_file).stats)
+
+
+def test_subcent_amounts(runner: CliRunner, use_temp_db: Literal['test_db.json']):
+    """Fractions of a cent are rejected, the ones in older databases are kept"""
+    temp_db = use_temp_db
+    records = [{"id": 1, "amount": 12.345, "description": "Sub"}, {"id": 2, "amount": 0.125, "description": "Sub2"}]
+    with open(temp_db, "w") as stream:
+        json.dump(records, stream)
+    assert runner.invoke(export_python, [f"--filename={temp_db}"]).output == (
+        "[Expense(id=1, amount=12.345, description='Sub'), Expense(id=2, amount=0.125, description='Sub2')]\n")
+    result = runner.invoke(add, ["1.005", "Kawa", f"--filename={temp_db}"])
+    assert (result.exit_code, result.output) == (1, "Błąd - Koszt może mieć najwyżej dwie cyfry po przecinku\n")
+    assert runner.invoke(add, ["1,50", "Kawa", f"--filename={temp_db}"]).output == "Dodano\n"
+    with open(temp_db) as stream:
+        assert [record["amount"] for record in json.load(stream)] == [12.345, 0.125, 1.5]
+
+
+def test_parse_cache(runner: CliRunner, use_temp_db: Literal['test_db.json'], monkeypatch: pytest.MonkeyPatch):
+    """--cache keeps parsed rows next to the database until the file changes"""
+    temp_db = use_temp_db
+    cache_file = temp_db + ".cache"
+    for amount, description in LIST_OF_ITEMS:
+        runner.invoke(add, [str(amount), description, f"--filename={temp_db}"])
+    expected = runner.invoke(report, [f"--filename={temp_db}"]).output
+    assert not os.path.exists(cache_file)
+    cached_report = ["--cache", "report", f"--filename={temp_db}"]
+    assert runner.invoke(clack, cached_report).output == expected
+    assert os.path.exists(cache_file)
+
+    with monkeypatch.context() as patch:
+        patch.setattr("expense_calculator.read_json_table", lambda *args: pytest.fail("json parsed again"))
+        result = runner.invoke(clack, cached_report)
+        assert result.exit_code == 0 and result.output == expected
+
+    # Edited by hand, with the same size and modification time
+    stat = os.stat(temp_db)
+    with open(temp_db, encoding="utf-8") as stream:
+        content = stream.read()
+    with open(temp_db, "w", encoding="utf-8") as stream:
+        stream.write(content.replace("Pizza", "Pasta"))
+    os.utime(temp_db, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert "Pasta" in runner.invoke(clack, cached_report).output
+
+    runner.invoke(add, ["5", "Kawa", f"--filename={temp_db}"])
+    assert not os.path.exists(cache_file)
+    with monkeypatch.context() as patch:
+        patch.setattr("expense_calculator.PARSE_CACHE_LIMIT", 10)
+        assert "Kawa" in runner.invoke(clack, cached_report).output
+        assert not os.path.exists(cache_file)
+
+    runner.invoke(clack, cached_report)
+    assert runner.invoke(clack, ["cache", "clear", f"--filename={temp_db}"]).output == \
+        "Usunięto pamięć podręczną bazy danych\n"
+    assert not os.path.exists(cache_file)
+    assert runner.invoke(clack, ["cache", "clear", f"--filename={temp_db}"]).output == \
+        "Brak pamięci podręcznej bazy danych\n"
+
+
+def test_search(runner: CliRunner, use_temp_db: Literal['test_db.json']):
+    temp_db = use_temp_db
+    for amount, description in [("12", "Obiad w restauracji"), ("3.5", "Kawa"), ("40", "obiad rodzinny")]:
+        runner.invoke(add, [amount, description, f"--filename={temp_db}"])
+    result = runner.invoke(search, ["obiad", f"--filename={temp_db}"])
+    assert "Budowanie indeksu wyszukiwania" in result.output
+    assert "Obiad w restauracji" in result.output and "obiad rodzinny" in result.output
+    assert "TOTAL:    52\n" in result.output
+
+    # Index is kept up to date by writes, it is not built again
+    runner.invoke(add, ["7", "Kawa duża", f"--filename={temp_db}", "--journal"])
+    runner.invoke(add, ["15", "Kawiarnia", f"--filename={temp_db}"])
+    result = runner.invoke(search, ["kaw*", "--max=10", f"--filename={temp_db}"])
+    assert "Budowanie" not in result.output
+    assert "TOTAL:    10.5\n" in result.output
+    assert runner.invoke(search, ["KAWA", "duża", f"--filename={temp_db}"]).output.count("Kawa") == 1
+    assert runner.invoke(search, ["--min=100", f"--filename={temp_db}"]).output == "Nie znaleziono wydatków\n"
+    assert runner.invoke(search, [f"--filename={temp_db}"]).exit_code == 2
+    for words in (["--", "-"], ["*"]):
+        result = runner.invoke(search, [f"--filename={temp_db}", *words])
+        assert result.exit_code == 2 and "Podaj szukane słowa albo zakres kosztów" in result.output
+    assert runner.invoke(search, ["--min=100", f"--filename={temp_db}", "--", "-"]).output == "Nie znaleziono wydatków\n"
+
+    # Databases changed behind its back get a fresh index
+    save_db([Expense(1, 5, "Kino")], temp_db)
+    result = runner.invoke(search, ["kino", f"--filename={temp_db}"])
+    assert "Budowanie indeksu wyszukiwania" in result.output
+    assert "TOTAL:    5\n" in result.output
+
+
+def test_summary(runner: CliRunner, use_temp_db: Literal['test_db.json']):
+    temp_db = use_temp_db
+    save_db([Expense(1, 12, "Obiad w domu"), Expense(2, 3.5, "Kawa"), Expense(3, 1500, "Czynsz"),
+             Expense(4, 2000, "czynsz"), Expense(5, 7, "Kawa")], temp_db)
+    result = runner.invoke(summary, [f"--filename={temp_db}", "--by=prefix", "--top=2"])
+    assert result.output == (
+        "=GROUP=   =COUNT=           =SUM=         =MIN=         =MAX=   =BIG=\n"
+        "czynsz          2            3500          1500          2000    100%\n"
+        "obiad           1              12            12            12      0%\n"
+        "TOTAL:    3512\n")
+    result = runner.invoke(summary, [f"--filename={temp_db}"])
+    assert result.output.splitlines()[1:3] == [
+        "czynsz               1            2000          2000          2000    100%",
+        "Czynsz               1            1500          1500          1500    100%"]
+
+
+def test_import_csv_duplicates(runner: CliRunner, use_temp_db: Literal['test_db.json'], use_temp_csv: Literal['temp.csv']):
+    temp_db = use_temp_db
+    temp_csv = use_temp_csv
+    assert runner.invoke(import_csv, [temp_csv, f"--filename={temp_db}"]).output == "Pomyślnie zaimportowano\n"
+    result = runner.invoke(import_csv, [temp_csv, f"--filename={temp_db}"])
+    assert result.output == "Pominięto 2 wierszy zaimportowanych już wcześniej\nPomyślnie zaimportowano\n"
+    result = runner.invoke(import_csv, [temp_csv, f"--filename={temp_db}", "--on-duplicate=error"])
+    assert result.exit_code == 1
+    assert result.output == "Błąd - Wiersz został już wcześniej zaimportowany (temp.csv, wiersz 2)\n"
+    assert len(read_db_or_init(temp_db)) == 2
+
+    # Equal rows within one export are separate expenses, as are rows of another export
+    with open("repeated.csv", "w") as file:
+        file.write("amount,description\n150,Test CSV 1\n150.00,Test CSV 1\n")
+    try:
+        result = runner.invoke(import_csv, ["repeated.csv", f"--filename={temp_db}", "--journal"])
+        assert result.output == "Pomyślnie zaimportowano\n"
+        result = runner.invoke(import_csv, ["repeated.csv", f"--filename={temp_db}", "--journal"])
+        assert result.output.startswith("Pominięto 2 wierszy")
+    finally:
+        os.remove("repeated.csv")
+    runner.invoke(import_csv, [temp_csv, f"--filename={temp_db}", "--on-duplicate=allow"])
+    assert [item.description for item in read_db_or_init(temp_db)] == [
+        "Test CSV 1", "Test CSV 2", "Test CSV 1", "Test CSV 1", "Test CSV 1", "Test CSV 2"]
+
+    # The same subscription in two monthly exports, and a copy of one of them
+    os.remove(temp_db)
+    with open("jan.csv", "w") as file:
+        file.write("amount,description\n43,Netflix\n12,Kawa\n")
+    with open("feb.csv", "w") as file:
+        file.write("amount,description\n43,Netflix\n55,Paliwo\n")
+    shutil.copyfile("feb.csv", "feb_copy.csv")
+    try:
+        assert runner.invoke(import_csv, ["jan.csv", f"--filename={temp_db}"]).output == "Pomyślnie zaimportowano\n"
+        result = runner.invoke(import_csv, ["feb.csv", "feb_copy.csv", f"--filename={temp_db}"])
+        assert result.output == "Pominięto 2 wierszy zaimportowanych już wcześniej\nPomyślnie zaimportowano\n"
+    finally:
+        for path in ("jan.csv", "feb.csv", "feb_copy.csv"):
+            os.remove(path)
+    assert [item.description for item in read_db_or_init(temp_db)] == ["Netflix", "Kawa", "Netflix", "Paliwo"]
+
+    # A database kept only in its journal (no snapshot yet) remembers fingerprints too
+    journal_db = "journal_only.json"
+    try:
+        for _ in range(2):
+            runner.invoke(import_csv, [temp_csv, f"--filename={journal_db}", "--journal"])
+        assert not os.path.exists(journal_db)
+        assert [item.id for item in read_db_or_init(journal_db)] == [1, 2]
+    finally:
+        for path in glob.glob(f"{journal_db}*"):
+            os.remove(path)
+
+    # A new database does not inherit fingerprints of the deleted one
+    os.remove(temp_db)
+    assert runner.invoke(import_csv, [temp_csv, f"--filename={temp_db}"]).output == "Pomyślnie zaimportowano\n"
+
+
+def test_serve(runner: CliRunner, use_temp_db: Literal['test_db.json'], use_temp_csv: Literal['temp.csv']):
+    """Commands started while serve runs are answered by it, rows reach the file in the background"""
+    temp_db = use_temp_db
+    runner.invoke(add, ["5", "Start", f"--filename={temp_db}"])
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "expense_calculator.py")
+    server = subprocess.Popen([sys.executable, script, "serve", f"--filename={temp_db}"],
+                              stdout=subprocess.PIPE, text=True)
+    try:
+        assert server.stdout.readline() == f"Serwer bazy danych {temp_db} działa\n"
+        assert runner.invoke(add, ["12", "Kawa", f"--filename={temp_db}"]).output == "Dodano\n"
+        assert runner.invoke(add, ["--batch", f"--filename={temp_db}"], input="1\tA\n").output == "Dodano\n"
+        runner.invoke(import_csv, [use_temp_csv, f"--filename={temp_db}"])
+        result = runner.invoke(import_csv, [use_temp_csv, f"--filename={temp_db}", "--on-duplicate=error"])
+        assert result.exit_code == 1
+        assert result.output == "Błąd - Wiersz został już wcześniej zaimportowany (temp.csv, wiersz 2)\n"
+        assert runner.invoke(report, ["--summary", f"--filename={temp_db}"]).output == (
+            "COUNT:    5\nTOTAL:    468\nBIG (!):  0\n")
+        # The server is the only one holding all rows until it persists them
+        assert len(read_db_or_init(temp_db)) < 5 or os.path.exists(temp_db + ".journal")
+    finally:
+        server.terminate()
+        assert server.wait(timeout=10) == 0
+    assert not os.path.exists(temp_db + ".sock")
+    assert [(item.id, item.description) for item in read_db_or_init(temp_db)] == [
+        (1, "Start"), (2, "Kawa"), (3, "A"), (4, "Test CSV 1"), (5, "Test CSV 2")]
+
+
+def test_served_import_fingerprints(runner: CliRunner, use_temp_db: Literal['test_db.json'],
+                                    use_temp_csv: Literal['temp.csv'], monkeypatch: pytest.MonkeyPatch):
+    """Fingerprints of rows imported through serve are saved only after the rows reach the file"""
+    temp_db = use_temp_db
+    storage = ResidentStorage(temp_db)
+    monkeypatch.setattr(expense_calculator, "_resident_storages", {os.path.abspath(temp_db): storage})
+    monkeypatch.setattr(expense_calculator, "_serving_thread", threading.get_ident())
+    assert runner.invoke(import_csv, [use_temp_csv, f"--filename={temp_db}"]).output == "Pomyślnie zaimportowano\n"
+    # Already known to the server before they are stored
+    result = runner.invoke(import_csv, [use_temp_csv, f"--filename={temp_db}"])
+    assert result.output == "Pominięto 2 wierszy zaimportowanych już wcześniej\nPomyślnie zaimportowano\n"
+
+    def fingerprints():
+        with contextlib.closing(sqlite3.connect(temp_db + ".dedup")) as connection:
+            return connection.execute("SELECT COUNT(*) FROM fingerprints").fetchone()[0]
+
+    def failing_append(expenses):
+        raise OSError("dysk pełny")
+
+    monkeypatch.setattr(storage.backing, "append", failing_append)
+    asyncio.run(persist_pending(storage))
+    assert (len(storage.pending), fingerprints()) == (2, 0)
+    monkeypatch.undo()
+    asyncio.run(persist_pending(storage))
+    assert (len(read_db_or_init(temp_db)), fingerprints()) == (2, 2)
+    assert not storage.pending and not storage.pending_fingerprints
+
+
+def test_export_formats(runner: CliRunner, use_temp_db: Literal['test_db.json'], monkeypatch: pytest.MonkeyPatch):
+    """export writes rows chunk by chunk, python format stays the same as export-python"""
+    temp_db = use_temp_db
+    monkeypatch.setattr("expense_calculator.RENDER_CHUNK_LINES", 2)
+    save_db([Expense(1, 987.0, "Chicken"), Expense(2, 12.5, 'Zażółć, "gęślą"'), Expense(3, 789.0, "Pizza")], temp_db)
+
+    python_export = runner.invoke(export, ["--format=python", f"--filename={temp_db}"]).output
+    assert python_export == runner.invoke(export_python, f"--filename={temp_db}").output
+    assert python_export == repr(read_db_or_init(temp_db)) + "\n"
+
+    ndjson_export = runner.invoke(export, [f"--filename={temp_db}"]).output
+    assert [json.loads(line) for line in ndjson_export.splitlines()] == [
+        {"id": 1, "amount": 987.0, "description": "Chicken"},
+        {"id": 2, "amount": 12.5, "description": 'Zażółć, "gęślą"'},
+        {"id": 3, "amount": 789.0, "description": "Pizza"}]
+
+    runner.invoke(export, ["--format=csv", "--gzip", "--output=temp_export.csv.gz", f"--filename={temp_db}"])
+    try:
+        with gzip.open("temp_export.csv.gz", "rt", encoding="utf-8", newline="") as stream:
+            csv_export = stream.read()
+        assert csv_export == 'id,amount,description\n1,987,Chicken\n2,12.5,"Zażółć, ""gęślą"""\n3,789,Pizza\n'
+        with open("temp_export.csv", "w", encoding="utf-8", newline="") as stream:
+            stream.write(csv_export)
+        copy_db = f"{temp_db}.copy.json"
+        runner.invoke(import_csv, ["temp_export.csv", f"--filename={copy_db}"])
+        assert read_db_or_init(copy_db) == read_db_or_init(temp_db)
+    finally:
+        for path in ["temp_export.csv.gz", "temp_export.csv"]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    empty_db = f"{temp_db}.empty.json"
+    assert runner.invoke(export, ["--format=python", f"--filename={empty_db}"]).output == "[]\n"
+    assert runner.invoke(export, ["--format=csv", f"--filename={empty_db}"]).output == "id,amount,description\n"
+
+
+def test_dates_and_partitioned_db(runner: CliRunner, use_temp_db: Literal['test_db.json']):
+    """Dated csv rows, report --from/--to and a directory database with a file per month"""
+    temp_db = use_temp_db
+    partitioned_db = f"{temp_db}.parts/"
+    with open("temp_dated.csv", "w") as file:
+        file.write("amount,description,date\n150,Czynsz,2024-04-30\n300,Zakupy,2024-05-02\n20,Kawa,\n"
+                   "1200,Laptop,2024-05-31\n")
+    try:
+        runner.invoke(add, ["5", "Start", f"--filename={temp_db}"])
+        assert runner.invoke(import_csv, ["temp_dated.csv", f"--filename={temp_db}"]).exit_code == 0
+        runner.invoke(add, ["12", "Kawa", "--date=2024-06-01", f"--filename={temp_db}"])
+        may = runner.invoke(report, [f"--filename={temp_db}", "--from=2024-05-01", "--to=2024-05-31"]).output
+        assert may == ("==ID==  ==Amount==  =BIG?=    =DATE=    =DESCRIPTION=\n"
+                       "  3       300                2024-05-02  Zakupy              \n"
+                       "  5       1200        (!)    2024-05-31  Laptop              \n"
+                       "TOTAL:    1500\n")
+        result = runner.invoke(report, [f"--filename={temp_db}", "--to=31.05.2024"])
+        assert (result.exit_code, result.output) == (1, "Błąd - Data musi mieć postać RRRR-MM-DD\n")
+
+        runner.invoke(migrate, [temp_db, partitioned_db])
+        assert sorted(glob.glob("*.json", root_dir=partitioned_db)) == [
+            "2024-04.json", "2024-05.json", "2024-06.json", "manifest.json", "undated.json"]
+        assert read_db_or_init(partitioned_db) == sorted(read_db_or_init(temp_db), key=lambda item: item.date or date.min)
+        assert runner.invoke(report, [f"--filename={partitioned_db}", "--from=2024-05-01", "--to=2024-05-31"]
+                             ).output == may
+
+        # Only the partition getting the row is rewritten
+        untouched = os.stat(os.path.join(partitioned_db, "2024-04.json")).st_mtime_ns
+        runner.invoke(add, ["7", "Bilet", "--date=2024-05-15", f"--filename={partitioned_db}"])
+        assert os.stat(os.path.join(partitioned_db, "2024-04.json")).st_mtime_ns == untouched
+        with open(os.path.join(partitioned_db, "manifest.json")) as stream:
+            manifest = json.load(stream)
+        assert manifest["partitions"]["2024-05"]["stats"] == {"count": 3, "cents": 150700, "big_count": 1,
+                                                              "extra_space": 0}
+        assert manifest["allocator"]["next_free"] == 8
+        assert [(item.id, item.description) for item in read_db_or_init(partitioned_db)] == [
+            (1, "Start"), (4, "Kawa"), (2, "Czynsz"), (3, "Zakupy"), (5, "Laptop"), (7, "Bilet"), (6, "Kawa")]
+
+        # Months outside the range are not opened, May is summed from the manifest
+        os.remove(os.path.join(partitioned_db, "2024-04.json"))
+        os.remove(os.path.join(partitioned_db, "2024-06.json"))
+        assert runner.invoke(report, ["--summary", f"--filename={partitioned_db}", "--from=2024-05-01"]
+                             ).output == "COUNT:    3\nTOTAL:    1507\nBIG (!):  1\n"
+    finally:
+        os.remove("temp_dated.csv")
+        shutil.rmtree(partitioned_db, ignore_errors=True)
+
+
+def test_partitioned_db_writers(runner: CliRunner, tmp_path):
+    """Rows appended with their ids (as serve does) claim them, group commit creates the directory"""
+    partitioned_db = str(tmp_path / "parts") + "/"
+    storage = open_storage(partitioned_db)
+    storage.add(10, "a")
+    storage.append([Expense(2, 20.0, "Z serwera")])
+    storage.add(30, "b")
+    assert [item.id for item in storage.load()] == [1, 2, 3]
+
+    new_db = str(tmp_path / "new") + "/"
+    assert runner.invoke(add, ["--group-commit", "5", "Kawa", f"--filename={new_db}"]).output == "Dodano\n"
+    assert [item.description for item in read_db_or_init(new_db)] == ["Kawa"]
+
+
+def test_partitioned_import_batches(tmp_path):
+    """Batches spilled per partition keep their order and are merged with the rows already there"""
+    partitioned_db = str(tmp_path / "parts") + "/"
+    storage = open_storage(partitioned_db)
+    storage.add(1, "Stary", date(2024, 5, 1))
+
+    def make_batches(allocator, stats):
+        for month in (5, 6, 5):
+            batch = [Expense(allocator.next_id(), 1000, f"{month}-{day}", date(2024, month, day))
+                     for day in (2, 3)]
+            for item in batch:
+                stats.add(item)
+            yield batch
+
+    storage.import_batches(make_batches)
+    assert [(item.id, item.description) for item in storage.load()] == [
+        (1, "Stary"), (2, "5-2"), (3, "5-3"), (6, "5-2"), (7, "5-3"), (4, "6-2"), (5, "6-3")]
+    assert storage.stats().count == 7
+    assert storage.range_stats(date(2024, 5, 1), date(2024, 5, 31)).cents == 400100
+    assert storage.add(2, "Nowy").id == 8